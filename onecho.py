@@ -5,20 +5,32 @@
 # - Lenfouriee
 from __future__ import annotations
 
+import array
 import asyncio
+import atexit
+import base64
+import bisect
+import functools
+import queue
 import random
 import string
+import tempfile
 import struct
 import traceback
-import urllib.request
 import urllib.parse
 import hashlib
 import glob
+import ipaddress
 import json
+import mimetypes
 import os
 import time
 import sys
 import socket
+import ssl
+import stat
+import threading
+import timeit
 
 from collections.abc import MutableMapping
 from collections.abc import Mapping
@@ -37,14 +49,89 @@ from enum import IntEnum
 from enum import IntFlag
 from dataclasses import dataclass
 from dataclasses import field
+from dataclasses import asdict
 
 # Global Constants START
 
 
 DEBUG = "debug" in sys.argv
+TAKEOVER = "takeover" in sys.argv
+BENCHMARK = "bench" in sys.argv
+FUZZ = "fuzz" in sys.argv
 SETTING_MAIN_DOMAIN = os.environ.get("MAIN_DOMAIN", "localhost")
 SETTING_HTTP_PORT = int(os.environ.get("HTTP_PORT", 2137))
 SETTING_HTTP_HOST = os.environ.get("HTTP_HOST", "0.0.0.0")
+SETTING_LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG" if DEBUG else "INFO")
+SETTING_LOG_FILE = os.environ.get("LOG_FILE")
+SETTING_LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES", 16 * 1024 * 1024))
+SETTING_LOG_FILE_BACKUPS = int(os.environ.get("LOG_FILE_BACKUPS", 5))
+SETTING_LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 512))
+SETTING_HTTP_TCP_ENABLED = os.environ.get("HTTP_TCP_ENABLED", "true").lower() == "true"
+SETTING_HTTP_UNIX_SOCKETS = [
+    path for path in os.environ.get("HTTP_UNIX_SOCKETS", "").split(",") if path
+]
+SETTING_HTTP_UNIX_SOCKET_MODE = int(os.environ.get("HTTP_UNIX_SOCKET_MODE", "666"), 8)
+SETTING_HTTP_BACKLOG = int(os.environ.get("HTTP_BACKLOG", socket.SOMAXCONN))
+SETTING_HANDOFF_SOCKET = os.environ.get("HANDOFF_SOCKET")
+SETTING_HANDOFF_DRAIN_TIMEOUT = float(os.environ.get("HANDOFF_DRAIN_TIMEOUT", 5))
+SETTING_HANDOFF_TIMEOUT = float(os.environ.get("HANDOFF_TIMEOUT", 30))
+SETTING_HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 1024))
+SETTING_HTTP_MAX_HEADER_SIZE = int(os.environ.get("HTTP_MAX_HEADER_SIZE", 16 * 1024))
+SETTING_HTTP_MAX_BODY_SIZE = int(os.environ.get("HTTP_MAX_BODY_SIZE", 8 * 1024 * 1024))
+SETTING_HTTP_MAX_UPLOAD_SIZE = int(
+    os.environ.get("HTTP_MAX_UPLOAD_SIZE", 64 * 1024 * 1024)
+)
+SETTING_HTTP_UPLOAD_SPOOL_SIZE = int(
+    os.environ.get("HTTP_UPLOAD_SPOOL_SIZE", 1024 * 1024)
+)
+SETTING_HTTP_IDLE_TIMEOUT = float(os.environ.get("HTTP_IDLE_TIMEOUT", 10))
+SETTING_HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+SETTING_HTTP_KEEP_ALIVE = os.environ.get("HTTP_KEEP_ALIVE", "true").lower() == "true"
+SETTING_HTTP_MAX_KEEP_ALIVE_REQUESTS = int(
+    os.environ.get("HTTP_MAX_KEEP_ALIVE_REQUESTS", 1000)
+)
+SETTING_HTTP_CONNECTION_TIMEOUT = float(os.environ.get("HTTP_CONNECTION_TIMEOUT", 120))
+SETTING_HTTP_CLIENT_TIMEOUT = float(os.environ.get("HTTP_CLIENT_TIMEOUT", 10))
+SETTING_HTTP_CLIENT_MAX_CONNECTIONS = int(
+    os.environ.get("HTTP_CLIENT_MAX_CONNECTIONS", 8)
+)
+SETTING_HTTP_CLIENT_IDLE_TIMEOUT = float(os.environ.get("HTTP_CLIENT_IDLE_TIMEOUT", 30))
+SETTING_METRICS_DOMAIN = os.environ.get(
+    "METRICS_DOMAIN", f"metrics.{SETTING_MAIN_DOMAIN}"
+)
+SETTING_METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+SETTING_SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", 0.5))
+SETTING_STATIC_FILE_CACHE_SIZE = int(os.environ.get("STATIC_FILE_CACHE_SIZE", 256))
+SETTING_STATIC_FILE_REVALIDATE_SECONDS = float(
+    os.environ.get("STATIC_FILE_REVALIDATE_SECONDS", 5)
+)
+SETTING_GEOLOCATION_CACHE_SIZE = int(os.environ.get("GEOLOCATION_CACHE_SIZE", 10000))
+SETTING_GEOLOCATION_CACHE_TTL = float(os.environ.get("GEOLOCATION_CACHE_TTL", 86400))
+SETTING_GEOLOCATION_NEGATIVE_TTL = float(
+    os.environ.get("GEOLOCATION_NEGATIVE_TTL", 300)
+)
+SETTING_GEOLOCATION_CACHE_FILE = os.environ.get("GEOLOCATION_CACHE_FILE")
+SETTING_GEOLOCATION_DATABASE = os.environ.get("GEOLOCATION_DATABASE")
+SETTING_GEOLOCATION_NETWORK = (
+    os.environ.get("GEOLOCATION_NETWORK", "true").lower() == "true"
+)
+SETTING_GEOLOCATION_DEFERRED = (
+    os.environ.get("GEOLOCATION_DEFERRED", "true").lower() == "true"
+)
+SETTING_GEOLOCATION_TIMEOUT = float(os.environ.get("GEOLOCATION_TIMEOUT", 5))
+SETTING_SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", 300))
+SETTING_SESSION_REAP_INTERVAL = float(os.environ.get("SESSION_REAP_INTERVAL", 30))
+SETTING_SESSION_REAP_BATCH_SIZE = int(os.environ.get("SESSION_REAP_BATCH_SIZE", 100))
+SETTING_USER_QUEUE_LIMIT = int(os.environ.get("USER_QUEUE_LIMIT", 1024 * 1024))
+SETTING_BROADCAST_LOG_SIZE = int(os.environ.get("BROADCAST_LOG_SIZE", 4 * 1024 * 1024))
+SETTING_PACKET_STATS_ENABLED = (
+    os.environ.get("PACKET_STATS_ENABLED", "true").lower() == "true"
+)
+SETTING_BENCHMARK_BATCH_SIZES = [
+    int(size) for size in os.environ.get("BENCHMARK_BATCH_SIZES", "1,16,256").split(",")
+]
+SETTING_FUZZ_ITERATIONS = int(os.environ.get("FUZZ_ITERATIONS", 20000))
+SETTING_FUZZ_SEED = int(os.environ.get("FUZZ_SEED", random.randrange(2**32)))
 
 STATUS_CODE = {
     100: "Continue",
@@ -316,6 +403,28 @@ class BanchoPacketID(IntEnum):
     OSU_TOURNAMENT_LEAVE_MATCH_CHANNEL = 109
 
 
+class MultipartState(IntEnum):
+    PREAMBLE = 0
+    DELIMITER = 1
+    HEADERS = 2
+    BODY = 3
+    DONE = 4
+
+
+class QueuePolicy(IntEnum):
+    # What happens to a queued packet once the queue is over its limit.
+    KEEP = 0
+    DROP = 1
+    COALESCE = 2
+
+
+class LogLevel(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+
 class Ansi(IntEnum):
     BLACK = 30
     RED = 31
@@ -347,56 +456,413 @@ class Ansi(IntEnum):
 # Logger START
 
 
-def info(text: str, *, extra: dict[str, Any] | None = None):
-    data = {
-        "level": "INFO",
-        "message": text,
-    }
+LogRecord = tuple[LogLevel, str, dict[str, Any] | None]
 
-    if extra:
-        data["extra"] = extra  # type: ignore
-    print(json.dumps(data))
 
+class LogSink:
+    def write(self, data: str) -> None:
+        raise NotImplementedError
 
-def error(text: str, *, extra: dict[str, Any] | None = None):
-    data = {
-        "level": "ERROR",
-        "message": text,
-    }
+    def close(self) -> None:
+        pass
 
-    if extra:
-        data["extra"] = extra  # type: ignore
-    print(json.dumps(data))
 
+class StdoutLogSink(LogSink):
+    def write(self, data: str) -> None:
+        sys.stdout.write(data)
+        sys.stdout.flush()
 
-def warning(text: str, *, extra: dict[str, Any] | None = None):
-    data = {
-        "level": "WARNING",
-        "message": text,
-    }
 
-    if extra:
-        data["extra"] = extra  # type: ignore
-    print(json.dumps(data))
+class RotatingFileLogSink(LogSink):
+    def __init__(self, *, file_name: str, max_bytes: int, backups: int) -> None:
+        self._file_name = file_name
+        self._max_bytes = max_bytes
+        self._backups = backups
 
+        self._file = open(self._file_name, "ab")
+        self._size = self._file.tell()
 
-def debug(text: str, *, extra: dict[str, Any] | None = None):
-    if not DEBUG:
-        return
+    def _rotate(self) -> None:
+        self._file.close()
 
-    data = {
-        "level": "DEBUG",
-        "message": text,
-    }
+        for i in range(self._backups - 1, 0, -1):
+            if os.path.exists(f"{self._file_name}.{i}"):
+                os.replace(f"{self._file_name}.{i}", f"{self._file_name}.{i + 1}")
+
+        if self._backups:
+            os.replace(self._file_name, f"{self._file_name}.1")
+
+        self._file = open(self._file_name, "wb")
+        self._size = 0
+
+    def write(self, data: str) -> None:
+        encoded = data.encode("utf-8")
+        if self._size and self._size + len(encoded) > self._max_bytes:
+            self._rotate()
+
+        self._file.write(encoded)
+        self._file.flush()
+        self._size += len(encoded)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class BatchedLogger:
+    def __init__(self, sink: LogSink, *, level: LogLevel, batch_size: int) -> None:
+        self.level = level
+
+        self._sink = sink
+        self._batch_size = batch_size
+        self._queue: queue.SimpleQueue[LogRecord | None] = queue.SimpleQueue()
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name="onecho-logger",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def log(self, level: LogLevel, text: str, extra: dict[str, Any] | None) -> None:
+        if level < self.level:
+            return
+
+        # Copied, it is serialised on the logger thread while the caller goes on.
+        self._queue.put((level, text, dict(extra) if extra else None))
+
+    @staticmethod
+    def _format(record: LogRecord) -> str:
+        level, text, extra = record
+        data: dict[str, Any] = {
+            "level": level.name,
+            "message": text,
+        }
+
+        if extra:
+            data["extra"] = extra
+        return json.dumps(data, default=str) + "\n"
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in batch:
+                if record is None:
+                    continue
+
+                # One record that can't be serialised mustn't take the thread down.
+                try:
+                    lines.append(self._format(record))
+                except Exception as exc:
+                    level, text, _ = record
+                    lines.append(
+                        self._format((level, str(text), {"format_error": repr(exc)}))
+                    )
+
+            try:
+                if lines:
+                    self._sink.write("".join(lines))
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+            if None in batch:
+                return
+
+    def close(self) -> None:
+        if not self._thread.is_alive():
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._sink.close()
+
+
+if SETTING_LOG_FILE:
+    log_sink: LogSink = RotatingFileLogSink(
+        file_name=SETTING_LOG_FILE,
+        max_bytes=SETTING_LOG_FILE_MAX_BYTES,
+        backups=SETTING_LOG_FILE_BACKUPS,
+    )
+else:
+    log_sink = StdoutLogSink()
+
+logger = BatchedLogger(
+    log_sink,
+    level=LogLevel[SETTING_LOG_LEVEL.upper()],
+    batch_size=SETTING_LOG_BATCH_SIZE,
+)
+atexit.register(logger.close)
+
+
+def info(text: str, *, extra: dict[str, Any] | None = None):
+    logger.log(LogLevel.INFO, text, extra)
 
-    if extra:
-        data["extra"] = extra  # type: ignore
-    print(json.dumps(data))
+
+def error(text: str, *, extra: dict[str, Any] | None = None):
+    logger.log(LogLevel.ERROR, text, extra)
+
+
+def warning(text: str, *, extra: dict[str, Any] | None = None):
+    logger.log(LogLevel.WARNING, text, extra)
+
+
+def debug(text: str, *, extra: dict[str, Any] | None = None):
+    logger.log(LogLevel.DEBUG, text, extra)
 
 
 # Logger END
 
 
+# Metrics START
+
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+FAST_LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues) -> str:
+    if not names:
+        return ""
+
+    pairs = ",".join(
+        f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...]) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.metric_type}",
+            *self._samples(),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...]) -> None:
+        super().__init__(name, description, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+            for label_values, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...]) -> None:
+        super().__init__(name, description, labels)
+        self._values: dict[LabelValues, float] = {}
+        self._function: Callable[[], dict[LabelValues, float]] | None = None
+
+    def set(self, value: float, *label_values: str) -> None:
+        self._values[label_values] = value
+
+    def set_function(self, function: Callable[[], dict[LabelValues, float]]) -> None:
+        # Computed on scrape instead of being kept up to date on the hot path.
+        self._function = function
+
+    def _samples(self) -> list[str]:
+        values = self._function() if self._function is not None else self._values
+        return [
+            f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+            for label_values, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...],
+        buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+        # label values -> per bucket counts (the last one being +Inf) and the sum.
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+            self._sums[label_values] = 0.0
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] += value
+
+    def get_count(self, *label_values: str) -> int:
+        return sum(self._counts.get(label_values, ()))
+
+    def get_sum(self, *label_values: str) -> float:
+        return self._sums.get(label_values, 0.0)
+
+    def _samples(self) -> list[str]:
+        samples = []
+        label_names = self.labels + ("le",)
+
+        for label_values, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                labels = _format_labels(label_names, label_values + (le,))
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = _format_labels(self.labels, label_values)
+            samples.append(f"{self.name}_sum{labels} {self._sums[label_values]}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register[M: Metric](self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name!r} is already registered.")
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, description: str, labels: tuple[str, ...] = ()
+    ) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def expose(self) -> str:
+        return "".join(metric.expose() for metric in self._metrics.values())
+
+
+metrics = MetricsRegistry()
+
+http_request_seconds = metrics.histogram(
+    "onecho_http_request_duration_seconds",
+    "Time spent handling a routed HTTP request.",
+    ("domain", "endpoint"),
+)
+database_operation_seconds = metrics.histogram(
+    "onecho_database_operation_duration_seconds",
+    "Time spent performing a CSV database operation.",
+    ("table", "operation"),
+    buckets=FAST_LATENCY_BUCKETS,
+)
+packets_total = metrics.counter(
+    "onecho_packets_total",
+    "Bancho packets received from or built for clients.",
+    ("direction", "packet"),
+)
+packets_dropped_total = metrics.counter(
+    "onecho_packets_dropped_total",
+    "Bancho packets received from clients and ignored.",
+    ("packet", "reason"),
+)
+packets_queued_total = metrics.counter(
+    "onecho_packets_queued_total",
+    "Bancho packets queued for delivery, counted once per recipient.",
+    ("packet",),
+)
+queued_packets_dropped_total = metrics.counter(
+    "onecho_queued_packets_dropped_total",
+    "Bancho packets dropped from a queue that went over its limit.",
+    ("packet", "reason"),
+)
+packet_bytes_total = metrics.counter(
+    "onecho_packet_bytes_total",
+    "Bancho packet payload bytes received from or queued for clients.",
+    ("direction", "packet"),
+)
+packet_handler_seconds = metrics.histogram(
+    "onecho_packet_handler_duration_seconds",
+    "Time spent in the handler of a received Bancho packet.",
+    ("packet",),
+    buckets=FAST_LATENCY_BUCKETS,
+)
+
+
+# Metrics END
+
+
 # Database START
 
 
@@ -448,6 +914,24 @@ class CSVModel:
         ]
 
 
+def _timed_database_operation[**P, R](
+    func: Callable[P, R],
+) -> Callable[P, R]:
+    @functools.wraps(func)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            database_operation_seconds.observe(
+                time.perf_counter() - start,
+                args[0]._file_name,  # type: ignore
+                func.__name__,
+            )
+
+    return wrapper
+
+
 class CSVBasedDatabase[T: CSVModel]:  # Based af.
     def __init__(
         self,
@@ -484,6 +968,7 @@ class CSVBasedDatabase[T: CSVModel]:  # Based af.
     def into_model(self, line: str) -> T:
         return self._parsing_model(*line.strip().split(","))
 
+    @_timed_database_operation
     def from_id(self, item_id: int) -> CSVResult[T] | None:
         if self._table_cache:
             if len(self._table_cache) + self._increment_from < item_id:
@@ -505,6 +990,7 @@ class CSVBasedDatabase[T: CSVModel]:  # Based af.
 
         return None
 
+    @_timed_database_operation
     def all(self) -> list[CSVResult[T]]:
         if self._table_cache:
             return [
@@ -520,6 +1006,7 @@ class CSVBasedDatabase[T: CSVModel]:  # Based af.
                 if line.strip() and not line.startswith("#")
             ]
 
+    @_timed_database_operation
     def insert(self, item: T) -> int:
         if self._cache_table:
             self._table_cache.append(",".join(item.into_str_list()) + "\n")
@@ -532,6 +1019,7 @@ class CSVBasedDatabase[T: CSVModel]:  # Based af.
 
         return self._increment_from + line_count - 1
 
+    @_timed_database_operation
     def update(self, item_id: int, item: T) -> None:
         with open(self._file_name, "r") as f:
             lines = f.readlines()
@@ -544,6 +1032,7 @@ class CSVBasedDatabase[T: CSVModel]:  # Based af.
         if self._cache_table:
             self._table_cache = lines
 
+    @_timed_database_operation
     def delete(self, item_id: int) -> None:
         with open(self._file_name, "r") as f:
             lines = f.readlines()
@@ -558,6 +1047,7 @@ class CSVBasedDatabase[T: CSVModel]:  # Based af.
         if self._cache_table:
             self._table_cache = lines
 
+    @_timed_database_operation
     def query(self, query: Callable[[T], bool]) -> list[CSVResult[T]]:
         if self._table_cache:
             return [
@@ -825,192 +1315,827 @@ class CaseInsensitiveDict(MutableMapping):
         return str(dict(self.items()))
 
 
-class HTTPRequest:
-    def __init__(self, client: socket.socket, server: AsyncHTTPServer) -> None:
-        self._client = client
-        self._server = server
+class StaticFile:
+    __slots__ = (
+        "path",
+        "file",
+        "size",
+        "mtime",
+        "inode",
+        "content_type",
+        "checked_at",
+        "_users",
+        "_evicted",
+    )
 
-        self.method: str
-        self.path: str
-        self.version: str
-        self.body: bytes
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.inode = stat.st_ino
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.checked_at = time.monotonic()
+
+        self._users = 0
+        self._evicted = False
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return (
+            stat.st_ino == self.inode
+            and stat.st_size == self.size
+            and stat.st_mtime == self.mtime
+        )
 
-        self.headers: CaseInsensitiveDict = CaseInsensitiveDict()
-        self.query_params: dict[str, str] = {}
-        self.post_params: dict[str, str] = {}
-        self.files: dict[str, bytes] = {}
+    def acquire(self) -> None:
+        self._users += 1
 
-    async def send_response(
-        self,
-        status_code: int,
-        headers: dict[str, str] = {},
-        body: bytes = b"",
-    ) -> None:
-        response = f"HTTP/1.1 {status_code} {STATUS_CODE[status_code]}\r\n"
+    def release(self) -> None:
+        self._users -= 1
+        if self._evicted and not self._users:
+            self.file.close()
 
-        for key, value in headers.items():
-            response += f"{key}: {value}\r\n"
+    def evict(self) -> None:
+        # Responses still being sent keep the descriptor open until they finish.
+        self._evicted = True
+        if not self._users:
+            self.file.close()
 
-        response += f"Content-Length: {len(body)}\r\n\r\n"
 
-        response = response.encode("utf-8") + body
+class StaticFileCache:
+    def __init__(self, *, max_size: int, revalidate_seconds: float) -> None:
+        self._max_size = max_size
+        self._revalidate_seconds = revalidate_seconds
+        self._files: OrderedDict[str, StaticFile] = OrderedDict()
 
-        try:
-            await asyncio.get_event_loop().sock_sendall(self._client, response)
-        except BrokenPipeError:
-            pass
+    def __len__(self) -> int:
+        return len(self._files)
 
-    async def send_json_response(
-        self,
-        status_code: int,
-        headers: dict[str, str] = {},
-        data: dict[str, Any] = {},
-    ) -> None:
-        headers["Content-Type"] = "application/json"
+    def _evict(self, path: str) -> None:
+        static_file = self._files.pop(path, None)
+        if static_file is not None:
+            static_file.evict()
 
-        await self.send_response(
-            status_code,
-            headers,
-            json.dumps(data).encode("utf-8"),
-        )
+    def get(self, path: str) -> StaticFile | None:
+        now = time.monotonic()
+        static_file = self._files.get(path)
 
-    def _parse_headers(self, headers_bytes: bytes) -> None:
-        headers = headers_bytes.decode("utf-8").split("\r\n")
+        if static_file is not None:
+            if now - static_file.checked_at < self._revalidate_seconds:
+                self._files.move_to_end(path)
+                return static_file
 
-        self.method, self.path, self.version = headers.pop(0).split(" ")
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._evict(path)
+                return None
 
-        if "?" in self.path:
-            self.path, query_params_raw = self.path.split("?")
+            if static_file.matches(stat):
+                static_file.checked_at = now
+                self._files.move_to_end(path)
+                return static_file
 
-            for query_param in query_params_raw.split("&"):
-                key, value = query_param.split("=", 1)
+            self._evict(path)
 
-                self.query_params[urllib.parse.unquote(key)] = urllib.parse.unquote(
-                    value
-                ).strip()
+        try:
+            static_file = StaticFile(path)
+        except (FileNotFoundError, IsADirectoryError, PermissionError):
+            return None
 
-        for header in headers:
-            key, value = header.split(": ")
-            self.headers[key] = value.strip()
+        self._files[path] = static_file
+        while len(self._files) > self._max_size:
+            _, oldest = self._files.popitem(last=False)
+            oldest.evict()
 
-    def _parse_multipart(self) -> None:
-        if "Content-Type" not in self.headers:
-            return
+        return static_file
 
-        boundary = "--" + self.headers["Content-Type"].split("; boundary=")[1]
+    def clear(self) -> None:
+        while self._files:
+            _, static_file = self._files.popitem()
+            static_file.evict()
 
-        form_data = self.body.split(boundary.encode("utf-8"))
-        for form_entry in form_data[:-1]:
-            if not form_entry.strip():
-                continue
 
-            headers, body = form_entry.split(b"\r\n\r\n", 1)
-            data_type, name = headers.split(b";")[1].strip().split(b"=")
+static_file_cache = StaticFileCache(
+    max_size=SETTING_STATIC_FILE_CACHE_SIZE,
+    revalidate_seconds=SETTING_STATIC_FILE_REVALIDATE_SECONDS,
+)
 
-            match data_type:
-                case b"name":
-                    self.post_params[name.decode().strip('"')] = body.decode(
-                        "utf-8"
-                    ).strip()
-                case b"filename":
-                    self.files[name.decode().strip('"')] = body
 
-    def _parse_www_form(self) -> None:
-        form_data = self.body.decode("utf-8")
+class HTTPHeaders(Mapping[str, str]):
+    # Names are lowercased once while parsing, values are only decoded when read.
+    __slots__ = ("_raw", "_decoded")
 
-        for form_entry in form_data.split("&"):
-            key, value = form_entry.split("=", 1)
+    def __init__(self, raw: dict[bytes, bytes] | None = None) -> None:
+        self._raw = raw if raw is not None else {}
+        self._decoded: dict[str, str] = {}
 
-            self.post_params[urllib.parse.unquote(key)] = urllib.parse.unquote(
-                value
-            ).strip()
+    @staticmethod
+    def parse(lines: list[bytes], start: int = 0) -> HTTPHeaders:
+        raw: dict[bytes, bytes] = {}
 
-    async def _parse_request(self) -> None:
-        buffer = bytearray()
+        for i in range(start, len(lines)):
+            name, sep, value = lines[i].partition(b":")
+            if not sep:
+                raise ValueError(f"Malformed header line {lines[i]!r}.")
 
-        loop = asyncio.get_event_loop()
-        while b"\r\n\r\n" not in buffer:
-            buffer += await loop.sock_recv(self._client, 1024)
+            raw[name.strip().lower()] = value.strip()
 
-        headers, self.body = buffer.split(b"\r\n\r\n", 1)
-        self._parse_headers(headers)
+        return HTTPHeaders(raw)
 
-        try:
-            content_len = int(self.headers["Content-Length"])
-        except KeyError:
-            return
+    def get_raw(self, name: bytes, default: bytes = b"") -> bytes:
+        # `name` has to already be lowercase.
+        return self._raw.get(name, default)
 
-        if content_len > len(self.body):
-            self.body += await loop.sock_recv(
-                self._client, content_len - len(self.body)
-            )
+    def __getitem__(self, key: str) -> str:
+        value = self._decoded.get(key)
+        if value is None:
+            raw_value = self._raw[key.lower().encode("latin-1")]
+            value = self._decoded[key] = raw_value.decode("latin-1")
 
-        content_type = self.headers.get("Content-Type", "")
-        if (
-            content_type.startswith("multipart/form-data")
-            or "form-data" in content_type
-            or "multipart/form-data" in content_type
-        ):
-            self._parse_multipart()
-        elif content_type in ("x-www-form", "application/x-www-form-urlencoded"):
-            self._parse_www_form()
+        return value
 
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, str):
+            return False
 
-HttpHandler = Callable[[HTTPRequest], Awaitable[None]]
-ServerEventHandler = Callable[[], Awaitable[None]]
+        return key in self._decoded or key.lower().encode("latin-1") in self._raw
 
+    def __iter__(self):
+        return (name.decode("latin-1") for name in self._raw)
 
-class Endpoint:
-    def __init__(self, path: str | set[str], handler: HttpHandler, methods: list[str]):
-        self.path = path
-        self.handler = handler
-        self.methods = methods
+    def __len__(self) -> int:
+        return len(self._raw)
 
-    def match(self, path: str) -> bool:
-        if isinstance(self.path, set):
-            return path in self.path
+    def __repr__(self) -> str:
+        return str(dict(self.items()))
 
-        ending_route = self.path.split("/")[-1]
-        if ending_route and ending_route[0] == "{" and ending_route[-1] == "}":
-            # let the handler handle the rest
-            endpoint_route_without_param = "/".join(self.path.split("/")[:-1])
-            return path.startswith(endpoint_route_without_param)
 
-        return self.path == path
+EMPTY_HEADERS = HTTPHeaders()
 
 
-class Router:
-    def __init__(self, domains: str | set[str]) -> None:
-        self.domains = domains
-        self.endpoints: set[Endpoint] = set()
+def _parse_url_encoded(data: str) -> dict[str, str]:
+    params: dict[str, str] = {}
 
-    def add_endpoint(
-        self, path: str | set[str], methods: list[str] = ["GET"]
-    ) -> Callable:
-        def decorator(handler: HttpHandler) -> HttpHandler:
-            self.endpoints.add(Endpoint(path, handler, methods))
-            return handler
+    for entry in data.split("&"):
+        if not entry:
+            continue
 
-        return decorator
+        key, _, value = entry.partition("=")
+        params[urllib.parse.unquote(key)] = urllib.parse.unquote(value).strip()
 
-    def match(self, domain: str) -> bool:
-        if isinstance(self.domains, set):
-            return domain in self.domains
+    return params
 
-        return self.domains == domain
 
-    def find_endpoint(self, path: str) -> Endpoint | None:
-        for endpoint in self.endpoints:
-            if endpoint.match(path):
-                return endpoint
+class UploadedFile:
+    # Stays in memory up to `spool_size` bytes, then rolls over to a temporary file.
+    __slots__ = ("name", "filename", "content_type", "size", "file")
 
-        return None
+    def __init__(
+        self, name: str, filename: str, content_type: str, spool_size: int
+    ) -> None:
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
 
+    def write(self, data: ByteLike) -> None:
+        self.file.write(data)
+        self.size += len(data)
 
-class AsyncHTTPServer:
-    def __init__(self, *, address: str, port: int) -> None:
-        self.address = address
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __repr__(self) -> str:
+        return f"<UploadedFile {self.filename!r} ({self.size} bytes)>"
+
+
+def _multipart_boundary(content_type: bytes) -> bytes:
+    media_type, _, params = content_type.partition(b";")
+    if media_type.strip().lower() != b"multipart/form-data":
+        return b""
+
+    for param in params.split(b";"):
+        key, _, value = param.partition(b"=")
+        if key.strip().lower() == b"boundary":
+            return value.strip().strip(b'"')
+
+    return b""
+
+
+class MultipartParser:
+    # Fed with the body as it arrives, so only the part being written sits in memory.
+    __slots__ = (
+        "_delimiter",
+        "_buffer",
+        "_state",
+        "_field_name",
+        "_field",
+        "_file",
+        "_spool_size",
+        "_max_field_size",
+        "fields",
+        "files",
+    )
+
+    MAX_PART_HEADER_SIZE = 8 * 1024
+
+    def __init__(self, boundary: bytes, spool_size: int, max_field_size: int) -> None:
+        # The leading CRLF lets the first boundary match the same delimiter.
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = bytearray(b"\r\n")
+        self._state = MultipartState.PREAMBLE
+
+        self._field_name = ""
+        self._field: bytearray | None = None
+        self._file: UploadedFile | None = None
+
+        self._spool_size = spool_size
+        self._max_field_size = max_field_size
+
+        self.fields: dict[str, str] = {}
+        self.files: dict[str, UploadedFile] = {}
+
+    def feed(self, data: ByteLike) -> None:
+        buffer = self._buffer
+        buffer += data
+
+        delimiter = self._delimiter
+        while True:
+            match self._state:
+                case MultipartState.PREAMBLE:
+                    index = buffer.find(delimiter)
+                    if index == -1:
+                        del buffer[: -len(delimiter)]
+                        return
+
+                    del buffer[: index + len(delimiter)]
+                    self._state = MultipartState.DELIMITER
+
+                case MultipartState.DELIMITER:
+                    if len(buffer) < 2:
+                        return
+
+                    if buffer.startswith(b"--"):
+                        self._state = MultipartState.DONE
+                        continue
+
+                    if not buffer.startswith(b"\r\n"):
+                        raise ValueError("Malformed multipart boundary.")
+
+                    del buffer[:2]
+                    self._state = MultipartState.HEADERS
+
+                case MultipartState.HEADERS:
+                    index = buffer.find(b"\r\n\r\n")
+                    if index == -1:
+                        if len(buffer) > self.MAX_PART_HEADER_SIZE:
+                            raise HTTPRequestError(413)
+
+                        return
+
+                    self._start_part(bytes(buffer[:index]))
+                    del buffer[: index + 4]
+                    self._state = MultipartState.BODY
+
+                case MultipartState.BODY:
+                    index = buffer.find(delimiter)
+                    if index == -1:
+                        # Keep enough of the tail to catch a delimiter split across reads.
+                        safe = len(buffer) - len(delimiter) + 1
+                        if safe > 0:
+                            self._write(buffer, safe)
+                            del buffer[:safe]
+
+                        return
+
+                    self._write(buffer, index)
+                    del buffer[: index + len(delimiter)]
+                    self._finish_part()
+                    self._state = MultipartState.DELIMITER
+
+                case MultipartState.DONE:
+                    buffer.clear()
+                    return
+
+    def close(self) -> None:
+        if self._state != MultipartState.DONE:
+            raise ValueError("Multipart body ended before the closing boundary.")
+
+    def discard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+        for file in self.files.values():
+            file.close()
+
+    def _start_part(self, raw_headers: bytes) -> None:
+        headers = HTTPHeaders.parse(raw_headers.split(b"\r\n"))
+
+        disposition: dict[bytes, bytes] = {}
+        for param in headers.get_raw(b"content-disposition").split(b";")[1:]:
+            key, _, value = param.partition(b"=")
+            disposition[key.strip().lower()] = value.strip().strip(b'"')
+
+        self._field_name = disposition.get(b"name", b"").decode("utf-8")
+        if b"filename" in disposition:
+            self._file = UploadedFile(
+                self._field_name,
+                disposition[b"filename"].decode("utf-8"),
+                headers.get("Content-Type", "application/octet-stream"),
+                self._spool_size,
+            )
+        else:
+            self._field = bytearray()
+
+    def _write(self, buffer: bytearray, end: int) -> None:
+        if self._file is not None:
+            with memoryview(buffer) as view:
+                self._file.write(view[:end])
+            return
+
+        if self._field is not None:
+            if len(self._field) + end > self._max_field_size:
+                raise HTTPRequestError(413)
+
+            self._field += buffer[:end]
+
+    def _finish_part(self) -> None:
+        if self._file is not None:
+            self._file.seek(0)
+            self.files[self._field_name] = self._file
+            self._file = None
+        elif self._field is not None:
+            self.fields[self._field_name] = self._field.decode("utf-8").strip()
+            self._field = None
+
+
+class HTTPRequestError(Exception):
+    def __init__(self, status_code: int) -> None:
+        super().__init__(f"{status_code} {STATUS_CODE[status_code]}")
+        self.status_code = status_code
+
+
+class HTTPRequest:
+    __slots__ = (
+        "_client",
+        "_server",
+        "method",
+        "path",
+        "version",
+        "body",
+        "headers",
+        "_raw_query",
+        "_query_params",
+        "_post_params",
+        "_files",
+        "keep_alive",
+        "_output",
+        "received_at",
+        "parsed_at",
+        "handler_started_at",
+        "send_duration",
+        "log_context",
+    )
+
+    def __init__(self, client: socket.socket, server: AsyncHTTPServer) -> None:
+        self._client = client
+        self._server = server
+
+        self.method = ""
+        self.path = ""
+        self.version = ""
+        self.body: ByteLike = b""
+
+        self.headers = EMPTY_HEADERS
+
+        # decoded on first access, most requests never look at them.
+        self._raw_query = ""
+        self._query_params: dict[str, str] | None = None
+        self._post_params: dict[str, str] | None = None
+        self._files: dict[str, UploadedFile] | None = None
+
+        self.keep_alive = False
+        # Set while pipelined responses are being gathered into a single write.
+        self._output: bytearray | None = None
+
+        # timings (perf_counter) and anything handlers want in the slow request log.
+        self.received_at = 0.0
+        self.parsed_at = 0.0
+        self.handler_started_at = 0.0
+        self.send_duration = 0.0
+        self.log_context: dict[str, Any] = {}
+
+    @property
+    def query_params(self) -> dict[str, str]:
+        if self._query_params is None:
+            self._query_params = _parse_url_encoded(self._raw_query)
+
+        return self._query_params
+
+    @property
+    def post_params(self) -> dict[str, str]:
+        if self._post_params is None:
+            self._parse_form()
+
+        return self._post_params  # type: ignore
+
+    @property
+    def files(self) -> dict[str, UploadedFile]:
+        if self._files is None:
+            self._parse_form()
+
+        return self._files  # type: ignore
+
+    @staticmethod
+    def _build_response_head(
+        status_code: int,
+        headers: dict[str, str],
+        content_length: int,
+        keep_alive: bool = False,
+    ) -> bytes:
+        response = f"HTTP/1.1 {status_code} {STATUS_CODE[status_code]}\r\n"
+
+        for key, value in headers.items():
+            response += f"{key}: {value}\r\n"
+
+        response += f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        response += f"Content-Length: {content_length}\r\n\r\n"
+        return response.encode("utf-8")
+
+    async def _write(self, data: ByteLike) -> None:
+        if self._output is not None:
+            self._output += data
+            return
+
+        await asyncio.get_event_loop().sock_sendall(self._client, data)
+
+    async def send_response(
+        self,
+        status_code: int,
+        headers: dict[str, str] = {},
+        body: bytes = b"",
+    ) -> None:
+        response = (
+            self._build_response_head(status_code, headers, len(body), self.keep_alive)
+            + body
+        )
+
+        start = time.perf_counter()
+        try:
+            await self._write(response)
+        except BrokenPipeError:
+            self.keep_alive = False
+        finally:
+            self.send_duration += time.perf_counter() - start
+
+    async def send_file_response(
+        self,
+        status_code: int,
+        static_file: StaticFile,
+        headers: dict[str, str] = {},
+    ) -> None:
+        if "Content-Type" not in headers:
+            headers = {"Content-Type": static_file.content_type, **headers}
+
+        head = self._build_response_head(
+            status_code, headers, static_file.size, self.keep_alive
+        )
+        loop = asyncio.get_event_loop()
+
+        # Anything gathered from pipelined requests has to go out before the file.
+        if self._output:
+            head = self._output + head
+            self._output.clear()
+
+        start = time.perf_counter()
+        static_file.acquire()
+        try:
+            await loop.sock_sendall(self._client, head)
+            try:
+                await loop.sock_sendfile(
+                    self._client,
+                    static_file.file,
+                    0,
+                    static_file.size,
+                    fallback=False,
+                )
+            except asyncio.SendfileNotAvailableError:
+                # The descriptor is shared, so never rely on its file position.
+                await loop.sock_sendall(
+                    self._client,
+                    os.pread(static_file.file.fileno(), static_file.size, 0),
+                )
+        except BrokenPipeError:
+            self.keep_alive = False
+        finally:
+            static_file.release()
+            self.send_duration += time.perf_counter() - start
+
+    async def send_json_response(
+        self,
+        status_code: int,
+        headers: dict[str, str] = {},
+        data: dict[str, Any] = {},
+    ) -> None:
+        headers["Content-Type"] = "application/json"
+
+        await self.send_response(
+            status_code,
+            headers,
+            json.dumps(data).encode("utf-8"),
+        )
+
+    def _parse_headers(self, headers_bytes: ByteLike) -> None:
+        lines = bytes(headers_bytes).split(b"\r\n")
+
+        self.method, path, self.version = lines[0].decode("utf-8").split(" ")
+        self.path, _, self._raw_query = path.partition("?")
+
+        self.headers = HTTPHeaders.parse(lines, start=1)
+
+        connection = self.headers.get_raw(b"connection").lower()
+        if self.version == "HTTP/1.1":
+            self.keep_alive = connection != b"close"
+        else:
+            self.keep_alive = connection == b"keep-alive"
+
+    def _parse_form(self) -> None:
+        # Multipart bodies are parsed while they are received, see `_receive_multipart`.
+        self._post_params = {}
+        self._files = {}
+
+        content_type = self.headers.get_raw(b"content-type").decode("latin-1")
+        if content_type in ("x-www-form", "application/x-www-form-urlencoded"):
+            self._parse_www_form()
+
+    def _parse_www_form(self) -> None:
+        self._post_params = _parse_url_encoded(self.body.decode("utf-8"))
+
+    async def _receive_multipart(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        buffer: bytearray,
+        content_len: int,
+        boundary: bytes,
+    ) -> None:
+        parser = MultipartParser(
+            boundary, self._server.upload_spool_size, self._server.max_body_size
+        )
+
+        try:
+            take = min(content_len, len(buffer))
+            if take:
+                parser.feed(buffer[:take])
+                del buffer[:take]
+
+            remaining = content_len - take
+            while remaining:
+                # Never read past the body, the next pipelined request may follow it.
+                data = await self._receive(loop, min(65536, remaining))
+                parser.feed(data)
+                remaining -= len(data)
+
+            parser.close()
+        except BaseException:
+            parser.discard()
+            raise
+
+        self._post_params = parser.fields
+        self._files = parser.files
+
+    def _close_files(self) -> None:
+        if self._files:
+            for file in self._files.values():
+                file.close()
+
+    async def _receive(self, loop: asyncio.AbstractEventLoop, size: int) -> bytes:
+        async with asyncio.timeout(self._server.idle_timeout):
+            data = await loop.sock_recv(self._client, size)
+
+        if not data:
+            raise ConnectionResetError("Client closed the connection mid-request.")
+
+        return data
+
+    async def _parse_request(self, buffer: bytearray) -> None:
+        # `buffer` belongs to the connection. Exactly one request is consumed from
+        # it, anything pipelined behind it is left for the next one.
+        max_header_size = self._server.max_header_size
+        if buffer:
+            self.received_at = time.perf_counter()
+
+        loop = asyncio.get_event_loop()
+        search_from = 0
+        while (header_end := buffer.find(b"\r\n\r\n", search_from)) == -1:
+            if len(buffer) > max_header_size:
+                raise HTTPRequestError(413)
+
+            search_from = max(0, len(buffer) - 3)
+            buffer += await self._receive(loop, 65536)
+            if not self.received_at:
+                self.received_at = time.perf_counter()
+
+        if header_end > max_header_size:
+            raise HTTPRequestError(413)
+
+        headers = buffer[:header_end]
+        del buffer[: header_end + 4]
+        self._parse_headers(headers)
+
+        self.body = b""
+        self.parsed_at = time.perf_counter()
+
+        if self.headers.get_raw(b"transfer-encoding"):
+            raise HTTPRequestError(411)
+
+        raw_content_len = self.headers.get_raw(b"content-length")
+        if not raw_content_len:
+            return
+
+        try:
+            content_len = int(raw_content_len)
+        except ValueError:
+            raise HTTPRequestError(400) from None
+
+        if content_len < 0:
+            raise HTTPRequestError(400)
+
+        boundary = _multipart_boundary(self.headers.get_raw(b"content-type"))
+        if boundary:
+            if content_len > self._server.max_upload_size:
+                raise HTTPRequestError(413)
+
+            await self._receive_multipart(loop, buffer, content_len, boundary)
+            self.parsed_at = time.perf_counter()
+            return
+
+        if content_len > self._server.max_body_size:
+            raise HTTPRequestError(413)
+
+        while content_len > len(buffer):
+            buffer += await self._receive(loop, 65536)
+
+        self.body = buffer[:content_len]
+        del buffer[:content_len]
+        self.parsed_at = time.perf_counter()
+
+
+HttpHandler = Callable[[HTTPRequest], Awaitable[None]]
+ServerEventHandler = Callable[[], Awaitable[None]]
+
+
+class Endpoint:
+    def __init__(self, path: str | set[str], handler: HttpHandler, methods: list[str]):
+        self.path = path
+        self.handler = handler
+        self.methods = methods
+
+        self.label = path if isinstance(path, str) else ",".join(sorted(path))
+
+    def match(self, path: str) -> bool:
+        if isinstance(self.path, set):
+            return path in self.path
+
+        ending_route = self.path.split("/")[-1]
+        if ending_route and ending_route[0] == "{" and ending_route[-1] == "}":
+            # let the handler handle the rest
+            endpoint_route_without_param = "/".join(self.path.split("/")[:-1])
+            return path.startswith(endpoint_route_without_param)
+
+        return self.path == path
+
+
+class Router:
+    def __init__(self, domains: str | set[str]) -> None:
+        self.domains = domains
+        self.endpoints: set[Endpoint] = set()
+
+    def add_endpoint(
+        self, path: str | set[str], methods: list[str] = ["GET"]
+    ) -> Callable:
+        def decorator(handler: HttpHandler) -> HttpHandler:
+            self.endpoints.add(Endpoint(path, handler, methods))
+            return handler
+
+        return decorator
+
+    def match(self, domain: str) -> bool:
+        if isinstance(self.domains, set):
+            return domain in self.domains
+
+        return self.domains == domain
+
+    def find_endpoint(self, path: str) -> Endpoint | None:
+        for endpoint in self.endpoints:
+            if endpoint.match(path):
+                return endpoint
+
+        return None
+
+
+class HTTPListener(NamedTuple):
+    address: str
+    port: int | None = None  # None means `address` is a unix socket path.
+
+    @property
+    def is_unix(self) -> bool:
+        return self.port is None
+
+    def __str__(self) -> str:
+        if self.is_unix:
+            return f"unix:{self.address}"
+
+        return f"{self.address}:{self.port}"
+
+    def create_socket(self, backlog: int) -> socket.socket:
+        if self.is_unix:
+            # A socket file left behind by a previous run would make bind fail.
+            try:
+                if stat.S_ISSOCK(os.stat(self.address).st_mode):
+                    os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.address)
+            os.chmod(self.address, SETTING_HTTP_UNIX_SOCKET_MODE)
+        else:
+            family = socket.AF_INET6 if ":" in self.address else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.address, self.port))
+
+        sock.setblocking(False)
+        sock.listen(backlog)
+        return sock
+
+    def close_socket(self, sock: socket.socket) -> None:
+        sock.close()
+
+        if self.is_unix:
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+
+class AsyncHTTPServer:
+    def __init__(
+        self,
+        *,
+        address: str,
+        port: int,
+        listen_tcp: bool = True,
+        backlog: int = SETTING_HTTP_BACKLOG,
+        max_connections: int = SETTING_HTTP_MAX_CONNECTIONS,
+        max_header_size: int = SETTING_HTTP_MAX_HEADER_SIZE,
+        max_body_size: int = SETTING_HTTP_MAX_BODY_SIZE,
+        max_upload_size: int = SETTING_HTTP_MAX_UPLOAD_SIZE,
+        upload_spool_size: int = SETTING_HTTP_UPLOAD_SPOOL_SIZE,
+        idle_timeout: float = SETTING_HTTP_IDLE_TIMEOUT,
+        read_timeout: float = SETTING_HTTP_READ_TIMEOUT,
+        connection_timeout: float = SETTING_HTTP_CONNECTION_TIMEOUT,
+        keep_alive: bool = SETTING_HTTP_KEEP_ALIVE,
+        max_keep_alive_requests: int = SETTING_HTTP_MAX_KEEP_ALIVE_REQUESTS,
+    ) -> None:
+        self.address = address
         self.port = port
+        self.backlog = backlog
+        self.listeners: list[HTTPListener] = []
+
+        if listen_tcp:
+            self.listeners.append(HTTPListener(address, port))
+
+        # limits!
+        self.max_connections = max_connections
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.max_upload_size = max_upload_size
+        self.upload_spool_size = upload_spool_size
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.connection_timeout = connection_timeout
+        self.keep_alive = keep_alive
+        self.max_keep_alive_requests = max_keep_alive_requests
+        self._connections: set[asyncio.Task] = set()
+
+        # listening sockets and their accept loops, kept around for handoffs.
+        self._sockets: list[tuple[HTTPListener, socket.socket]] = []
+        self._inherited_sockets: dict[HTTPListener, socket.socket] = {}
+        self._accept_tasks: set[asyncio.Task] = set()
+        self._stopped = asyncio.Event()
+        self._draining = False
+        self._handed_off = False
 
         self.on_start_server_coroutine: ServerEventHandler | None = None
         self.on_close_server_coroutine: ServerEventHandler | None = None
@@ -1023,6 +2148,17 @@ class AsyncHTTPServer:
         # statistics!
         self.requests_served = 0
 
+    @property
+    def active_connections(self) -> int:
+        return len(self._connections)
+
+    def add_listener(self, listener: HTTPListener) -> None:
+        self.listeners.append(listener)
+
+    def adopt_socket(self, listener: HTTPListener, sock: socket.socket) -> None:
+        sock.setblocking(False)
+        self._inherited_sockets[listener] = sock
+
     def on_start_server(self, coro: ServerEventHandler) -> None:
         self.on_start_server_coroutine = coro
 
@@ -1058,6 +2194,7 @@ class AsyncHTTPServer:
                 await response_405(request)
                 return
 
+            start = time.perf_counter()
             for coro in self.before_request_coroutines:
                 await coro(request)
 
@@ -1066,63 +2203,234 @@ class AsyncHTTPServer:
             for coro in self.after_request_coroutines:
                 await coro(request)
 
+            http_request_seconds.observe(
+                time.perf_counter() - start, host, endpoint.label
+            )
+
         except Exception:
             tb = traceback.format_exc()
             error(f"An error occurred while handling request.\n{tb}")
             await response_500(request, tb)
 
-    async def _handle_request(self, client: socket.socket) -> None:
-        request = HTTPRequest(client, self)
-        await request._parse_request()
-
-        if "Host" not in request.headers:
+    @staticmethod
+    def _close_client(client: socket.socket) -> None:
+        try:
             client.shutdown(socket.SHUT_RDWR)
             client.close()
-            return
+        except OSError:
+            pass
 
-        await self._handle_routing(request)
+    def _reject_client(self, client: socket.socket) -> None:
+        # The response is tiny, so a single non-blocking send is good enough.
+        try:
+            client.send(SERVICE_UNAVAILABLE_RESPONSE)
+        except OSError:
+            pass
+
+        self._close_client(client)
 
+    async def _read_request(self, request: HTTPRequest, buffer: bytearray) -> bool:
         try:
-            client.shutdown(socket.SHUT_RDWR)
-            client.close()
+            async with asyncio.timeout(self.read_timeout):
+                await request._parse_request(buffer)
+        except TimeoutError:
+            # Nothing arrived at all, so this is just an idle connection to close.
+            if request.received_at:
+                request.keep_alive = False
+                await response_error(request, 408)
+        except HTTPRequestError as exc:
+            request.keep_alive = False
+            await response_error(request, exc.status_code)
+        except (ValueError, UnicodeDecodeError):
+            request.keep_alive = False
+            await response_error(request, 400)
+        except OSError:
+            pass  # The client went away, there is nobody to respond to.
+        else:
+            return True
+
+        return False
+
+    async def _handle_connection(self, client: socket.socket) -> None:
+        loop = asyncio.get_event_loop()
+        buffer = bytearray()
+        output = bytearray()
+        handled = 0
+
+        try:
+            while True:
+                request = HTTPRequest(client, self)
+
+                # Responses are being gathered, later ones must queue behind them.
+                if output:
+                    request._output = output
+
+                try:
+                    # The deadline covers a single request, not the connection lifetime.
+                    async with asyncio.timeout(self.connection_timeout):
+                        if not await self._read_request(request, buffer):
+                            break
+
+                        if "Host" not in request.headers:
+                            break
+
+                        handled += 1
+                        if (
+                            not self.keep_alive
+                            or self._draining
+                            or handled >= self.max_keep_alive_requests
+                        ):
+                            request.keep_alive = False
+
+                        # The next request is already here, answer both in one write.
+                        if request.keep_alive and b"\r\n\r\n" in buffer:
+                            request._output = output
+
+                        await self._handle_routing(request)
+
+                        if output and (
+                            not request.keep_alive or b"\r\n\r\n" not in buffer
+                        ):
+                            await loop.sock_sendall(client, output)
+                            output.clear()
+                finally:
+                    # Spooled uploads only live as long as their request.
+                    request._close_files()
+
+                self.requests_served += 1
+
+                path = f"{request.headers['Host']}{request.path}"
+                info(f"Handled {request.method} {path}")
+
+                if not request.keep_alive:
+                    break
+
+            if output:
+                await loop.sock_sendall(client, output)
+        except TimeoutError:
+            warning(
+                f"Request exceeded the {self.connection_timeout}s timeout, dropping the connection."
+            )
+
+            # Earlier pipelined requests were handled, their responses still go out.
+            if output:
+                try:
+                    async with asyncio.timeout(self.read_timeout):
+                        await loop.sock_sendall(client, output)
+                except (TimeoutError, OSError):
+                    pass
         except OSError:
             pass
+        finally:
+            self._close_client(client)
+
+    async def _accept_connections(self, sock: socket.socket) -> None:
+        loop = asyncio.get_event_loop()
+
+        while True:
+            try:
+                client, _ = await loop.sock_accept(sock)
+            except OSError as exc:
+                # Most likely out of file descriptors, give handlers a moment to finish.
+                error(f"Failed to accept a connection: {exc}")
+                await asyncio.sleep(0.1)
+                continue
+
+            if len(self._connections) >= self.max_connections:
+                self._reject_client(client)
+                continue
+
+            task = loop.create_task(self._handle_connection(client))
+            self._connections.add(task)
+            task.add_done_callback(self._connections.discard)
 
-        self.requests_served += 1
+    @property
+    def listening_sockets(self) -> list[tuple[HTTPListener, socket.socket]]:
+        return list(self._sockets)
+
+    def pause_accepting(self) -> None:
+        for task in self._accept_tasks:
+            task.cancel()
 
-        path = f"{request.headers['Host']}{request.path}"
-        info(f"Handled {request.method} {path}")
+        self._accept_tasks.clear()
+
+    def resume_accepting(self) -> None:
+        loop = asyncio.get_event_loop()
+        self._draining = False
+
+        for _, sock in self._sockets:
+            self._accept_tasks.add(loop.create_task(self._accept_connections(sock)))
+
+    async def drain(self, timeout: float) -> None:
+        self._draining = True
+        if not self._connections:
+            return
+
+        _, pending = await asyncio.wait(set(self._connections), timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    @property
+    def handed_off(self) -> bool:
+        return self._handed_off
+
+    def stop(self, *, handed_off: bool = False) -> None:
+        self._handed_off = handed_off
+        self._stopped.set()
 
     async def start_server(self) -> None:
         if self.on_start_server_coroutine is not None:
             await self.on_start_server_coroutine()
 
-        info(
-            f"Starting HTTP server on {self.address}:{self.port}",
-        )
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.setblocking(False)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if not self.listeners:
+            raise ValueError("The HTTP server has nowhere to listen on.")
 
-            sock.bind((self.address, self.port))
-            sock.listen(5)
+        try:
+            for listener in self.listeners:
+                sock = self._inherited_sockets.pop(listener, None)
+                if sock is not None:
+                    info(f"Resuming HTTP server on {listener}")
+                else:
+                    sock = listener.create_socket(self.backlog)
+                    info(f"Starting HTTP server on {listener}")
+
+                self._sockets.append((listener, sock))
+
+            # Handed to us but no longer configured.
+            for sock in self._inherited_sockets.values():
+                sock.close()
+            self._inherited_sockets.clear()
+
+            self.resume_accepting()
+            await self._stopped.wait()
+        except asyncio.exceptions.CancelledError:
+            pass
+        finally:
+            self.pause_accepting()
 
-            loop = asyncio.get_event_loop()
-            should_close = False
-            try:
-                while not should_close:
-                    await asyncio.sleep(0.01)
+            for listener, sock in self._sockets:
+                # The new process is still listening on these.
+                if self._handed_off:
+                    sock.close()
+                else:
+                    listener.close_socket(sock)
 
-                    client, _ = await loop.sock_accept(sock)
-                    loop.create_task(self._handle_request(client))
-            except asyncio.exceptions.CancelledError:
-                should_close = True
+            self._sockets.clear()
 
         if self.on_close_server_coroutine is not None:
             await self.on_close_server_coroutine()
 
 
+SERVICE_UNAVAILABLE_RESPONSE = (
+    HTTPRequest._build_response_head(
+        503, {"Retry-After": "1"}, len(b"503 Service Unavailable")
+    )
+    + b"503 Service Unavailable"
+)
+
+
 # HTTP Server END
 
 
@@ -1143,6 +2451,13 @@ async def response_405(request: HTTPRequest) -> None:
     )
 
 
+async def response_error(request: HTTPRequest, status_code: int) -> None:
+    await request.send_response(
+        status_code=status_code,
+        body=f"{status_code} {STATUS_CODE[status_code]}".encode(),
+    )
+
+
 async def response_500(request: HTTPRequest, tb: str) -> None:
     await request.send_response(
         status_code=500,
@@ -1150,6 +2465,80 @@ async def response_500(request: HTTPRequest, tb: str) -> None:
     )
 
 
+async def response_static_file(
+    request: HTTPRequest,
+    path: str,
+    headers: dict[str, str] = {},
+) -> None:
+    static_file = static_file_cache.get(path)
+
+    if static_file is None:
+        await response_404(request)
+        return
+
+    await request.send_file_response(
+        status_code=200,
+        static_file=static_file,
+        headers=headers,
+    )
+
+
+class RequestTimingMiddleware:
+    def __init__(self, *, slow_threshold: float) -> None:
+        self.slow_threshold = slow_threshold
+
+        self.parse_seconds = metrics.histogram(
+            "onecho_http_parse_duration_seconds",
+            "Time from the first received byte until the request was parsed.",
+            ("domain",),
+            buckets=FAST_LATENCY_BUCKETS,
+        )
+        self.handler_seconds = metrics.histogram(
+            "onecho_http_handler_duration_seconds",
+            "Time spent in the endpoint handler, excluding sending the response.",
+            ("domain",),
+        )
+        self.send_seconds = metrics.histogram(
+            "onecho_http_send_duration_seconds",
+            "Time spent writing the response to the socket.",
+            ("domain",),
+            buckets=FAST_LATENCY_BUCKETS,
+        )
+
+    def install(self, server: AsyncHTTPServer) -> None:
+        server.before_request_coroutines.append(self.before_request)
+        server.after_request_coroutines.append(self.after_request)
+
+    async def before_request(self, request: HTTPRequest) -> None:
+        request.handler_started_at = time.perf_counter()
+
+    async def after_request(self, request: HTTPRequest) -> None:
+        now = time.perf_counter()
+        domain = request.headers["Host"]
+
+        parse_duration = request.parsed_at - request.received_at
+        handler_duration = now - request.handler_started_at - request.send_duration
+
+        self.parse_seconds.observe(parse_duration, domain)
+        self.handler_seconds.observe(handler_duration, domain)
+        self.send_seconds.observe(request.send_duration, domain)
+
+        duration = now - request.received_at
+        if duration < self.slow_threshold:
+            return
+
+        warning(
+            f"Slow request {request.method} {domain}{request.path} "
+            f"took {duration * 1000:.2f}ms",
+            extra={
+                "parse_ms": round(parse_duration * 1000, 3),
+                "handler_ms": round(handler_duration * 1000, 3),
+                "send_ms": round(request.send_duration * 1000, 3),
+                **request.log_context,
+            },
+        )
+
+
 # HTTP Middleware END
 
 
@@ -1172,7 +2561,136 @@ class HTTPResponse:
         return json.loads(self.body)
 
 
+class HTTPClientConnection:
+    __slots__ = ("reader", "writer", "last_used")
+
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def is_reusable(self, idle_timeout: float) -> bool:
+        return (
+            not self.reader.at_eof()
+            and not self.writer.is_closing()
+            and time.monotonic() - self.last_used < idle_timeout
+        )
+
+    def close(self) -> None:
+        self.writer.close()
+
+
 class HTTPClient:
+    # Keeps idle connections around per (scheme, host, port) so consecutive
+    # requests to the same service skip the TCP (and TLS) handshake.
+    def __init__(
+        self,
+        *,
+        timeout: float = SETTING_HTTP_CLIENT_TIMEOUT,
+        max_connections: int = SETTING_HTTP_CLIENT_MAX_CONNECTIONS,
+        idle_timeout: float = SETTING_HTTP_CLIENT_IDLE_TIMEOUT,
+    ) -> None:
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        self._pools: dict[tuple[str, str, int], list[HTTPClientConnection]] = {}
+        self._limits: dict[tuple[str, str, int], asyncio.Semaphore] = {}
+        self._ssl_context: ssl.SSLContext | None = None
+
+    async def _connect(self, key: tuple[str, str, int]) -> HTTPClientConnection:
+        scheme, host, port = key
+
+        ssl_context = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+        return HTTPClientConnection(reader, writer)
+
+    def _acquire(self, key: tuple[str, str, int]) -> HTTPClientConnection | None:
+        pool = self._pools.get(key)
+
+        while pool:
+            connection = pool.pop()
+            if connection.is_reusable(self.idle_timeout):
+                return connection
+
+            connection.close()
+
+        return None
+
+    def _release(
+        self, key: tuple[str, str, int], connection: HTTPClientConnection
+    ) -> None:
+        connection.last_used = time.monotonic()
+        self._pools.setdefault(key, []).append(connection)
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        body = bytearray()
+
+        while True:
+            size_line = await reader.readuntil(b"\r\n")
+            size = int(size_line.split(b";", 1)[0], 16)
+            if not size:
+                break
+
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+
+        # Skip trailers, they are never used.
+        while await reader.readuntil(b"\r\n") != b"\r\n":
+            pass
+
+        return bytes(body)
+
+    async def _exchange(
+        self,
+        connection: HTTPClientConnection,
+        method: str,
+        request_head: bytes,
+        body: bytes,
+    ) -> tuple[int, int, CaseInsensitiveDict, bytes, bool]:
+        connection.writer.write(request_head + body)
+        await connection.writer.drain()
+
+        reader = connection.reader
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head[:-4].decode("latin-1").split("\r\n")
+
+        version, status, _ = (lines[0] + " ").split(" ", 2)
+        status_code = int(status)
+        http_version = 11 if version == "HTTP/1.1" else 10
+
+        headers = CaseInsensitiveDict()
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip()] = value.strip()
+
+        connection_header = headers.get("Connection", "").lower()
+        if http_version == 11:
+            keep_alive = connection_header != "close"
+        else:
+            keep_alive = connection_header == "keep-alive"
+
+        if method == "HEAD" or status_code in (204, 304) or status_code < 200:
+            response_body = b""
+        elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+            response_body = await self._read_chunked(reader)
+        elif "Content-Length" in headers:
+            response_body = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            # The body runs until the server closes the connection.
+            response_body = await reader.read()
+            keep_alive = False
+
+        return status_code, http_version, headers, response_body, keep_alive
+
     async def __make_request(
         self,
         method: str,
@@ -1183,24 +2701,79 @@ class HTTPClient:
     ) -> HTTPResponse:
         query_data = urllib.parse.urlencode(query_params)
         if query_data:
-            url += f"?{query_data}"
-
-        req = urllib.request.Request(url, method=method, data=body, headers=headers)
-        response = await asyncio.to_thread(urllib.request.urlopen, req)
-        body = await asyncio.to_thread(response.read)
-
-        case_headers = CaseInsensitiveDict()
-        for key, value in response.headers.items():
-            case_headers[key] = value
+            url += f"?{query_data}" if "?" not in url else f"&{query_data}"
+
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Unsupported URL {url!r}.")
+
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+
+        target = parts.path or "/"
+        if parts.query:
+            target += f"?{parts.query}"
+
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{port}"
+        request_head = f"{method} {target} HTTP/1.1\r\nHost: {host}\r\n"
+        request_head += f"Content-Length: {len(body)}\r\n"
+        for header_name, header_value in headers.items():
+            request_head += f"{header_name}: {header_value}\r\n"
+
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = asyncio.Semaphore(self.max_connections)
+
+        async with limit, asyncio.timeout(self.timeout):
+            connection = self._acquire(key)
+            reused = connection is not None
+
+            while True:
+                if connection is None:
+                    connection = await self._connect(key)
+
+                try:
+                    result = await self._exchange(
+                        connection, method, (request_head + "\r\n").encode(), body
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+
+                    # The server may have dropped an idle connection, retry once on
+                    # a fresh one.
+                    if not reused:
+                        raise
+
+                    connection = None
+                    reused = False
+                    continue
+                except BaseException:
+                    connection.close()
+                    raise
+
+                break
+
+        status_code, http_version, response_headers, response_body, keep_alive = result
+        if keep_alive:
+            self._release(key, connection)
+        else:
+            connection.close()
 
         return HTTPResponse(
-            url=response.url,
-            status_code=response.status,
-            http_version=response.version,
-            headers=case_headers,
-            body=body,
+            url=url,
+            status_code=status_code,
+            http_version=http_version,
+            headers=response_headers,
+            body=response_body,
         )
 
+    async def close(self) -> None:
+        for pool in self._pools.values():
+            for connection in pool:
+                connection.close()
+
+        self._pools.clear()
+
     async def get(
         self,
         url: str,
@@ -1220,6 +2793,9 @@ class HTTPClient:
         return await self.__make_request("POST", url, headers, query_params, body)
 
 
+http_client = HTTPClient()
+
+
 # HTTP Client END
 
 
@@ -1244,37 +2820,353 @@ class UserGeolocalisation:
     longitude: float
 
 
-async def get_user_geolocalisation(ip: str | None) -> UserGeolocalisation:
-    http_client = HTTPClient()
+FALLBACK_GEOLOCALISATION = UserGeolocalisation(  # Mumbai, India.
+    country_acronym="in",
+    country_code=COUNTRY_CODES["in"],
+    latitude=19.0760,
+    longitude=72.7777,  # Fixed this.
+)
 
-    if ip is None or ip in ("127.0.0.1", "localhost"):
+geolocation_lookups_total = metrics.counter(
+    "onecho_geolocation_lookups_total",
+    "IP geolocation lookups by how they were answered.",
+    ("result",),
+)
+
+
+class GeolocationCache:
+    # Failed lookups are cached as None for a shorter time, so a broken API
+    # is not hammered on every login either.
+    def __init__(
+        self,
+        *,
+        max_size: int,
+        ttl: float,
+        negative_ttl: float,
+        path: str | None = None,
+    ) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._path = path
+
+        # Expiry uses wall time so entries survive being saved to disk.
+        self._entries: OrderedDict[str, tuple[float, UserGeolocalisation | None]] = (
+            OrderedDict()
+        )
+        self._in_flight: dict[str, asyncio.Task[UserGeolocalisation | None]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> tuple[bool, UserGeolocalisation | None]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        expires_at, geoloc = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, geoloc
+
+    def set(self, key: str, geoloc: UserGeolocalisation | None) -> None:
+        ttl = self._ttl if geoloc is not None else self._negative_ttl
+
+        self._entries[key] = (time.time() + ttl, geoloc)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    async def _fetch(
+        self, key: str, fetch: Callable[[], Awaitable[UserGeolocalisation | None]]
+    ) -> UserGeolocalisation | None:
+        try:
+            geoloc = await fetch()
+        finally:
+            del self._in_flight[key]
+
+        self.set(key, geoloc)
+        return geoloc
+
+    async def lookup(
+        self, key: str, fetch: Callable[[], Awaitable[UserGeolocalisation | None]]
+    ) -> UserGeolocalisation | None:
+        found, geoloc = self.get(key)
+        if found:
+            geolocation_lookups_total.inc("hit" if geoloc is not None else "negative")
+            return geoloc
+
+        # Concurrent logins from the same address share a single request.
+        task = self._in_flight.get(key)
+        if task is not None:
+            geolocation_lookups_total.inc("coalesced")
+        else:
+            geolocation_lookups_total.inc("miss")
+            task = asyncio.get_event_loop().create_task(self._fetch(key, fetch))
+            self._in_flight[key] = task
+
+        # A waiter giving up must not cancel the lookup for everyone else.
+        return await asyncio.shield(task)
+
+    def load(self) -> None:
+        if self._path is None:
+            return
+
+        try:
+            with open(self._path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            warning(f"Could not load the geolocation cache: {exc}")
+            return
+
+        now = time.time()
+        for key, (expires_at, geoloc) in data.items():
+            if expires_at <= now:
+                continue
+
+            self._entries[key] = (
+                expires_at,
+                UserGeolocalisation(**geoloc) if geoloc is not None else None,
+            )
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+        info(f"Loaded {len(self._entries)} cached geolocations.")
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+
+        data = {
+            key: [expires_at, asdict(geoloc) if geoloc is not None else None]
+            for key, (expires_at, geoloc) in self._entries.items()
+        }
+
+        temp_path = f"{self._path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self._path)
+        except OSError as exc:
+            warning(f"Could not save the geolocation cache: {exc}")
+
+
+geolocation_cache = GeolocationCache(
+    max_size=SETTING_GEOLOCATION_CACHE_SIZE,
+    ttl=SETTING_GEOLOCATION_CACHE_TTL,
+    negative_ttl=SETTING_GEOLOCATION_NEGATIVE_TTL,
+    path=SETTING_GEOLOCATION_CACHE_FILE,
+)
+
+
+class IPRangeDatabase:
+    # Rows are `start_ip,end_ip,country[,latitude,longitude]`, ranges must not
+    # overlap. They are kept in parallel sorted arrays so a lookup is one bisect.
+    def __init__(self) -> None:
+        self._acronyms: list[str] = []
+        self._clear()
+
+    def _clear(self) -> None:
+        self._v4_starts = array.array("I")
+        self._v4_ends = array.array("I")
+        self._v4_rows = array.array("I")
+
+        # IPv6 addresses don't fit into a machine word, plain ints it is.
+        self._v6_starts: list[int] = []
+        self._v6_ends: list[int] = []
+        self._v6_rows = array.array("I")
+
+        self._countries = array.array("H")
+        self._latitudes = array.array("f")
+        self._longitudes = array.array("f")
+
+    def __len__(self) -> int:
+        return len(self._countries)
+
+    @staticmethod
+    def _parse_address(address: str) -> tuple[int, int] | None:
+        try:
+            ip = ipaddress.ip_address(address.strip())
+        except ValueError:
+            return None
+
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+
+        return ip.version, int(ip)
+
+    def load(self, path: str) -> None:
+        ranges: dict[int, list[tuple[int, int, int]]] = {4: [], 6: []}
+        acronyms = {acronym: index for index, acronym in enumerate(self._acronyms)}
+        self._clear()
+
+        with open(path, "r") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                columns = line.split(",")
+                start = self._parse_address(columns[0])
+                end = self._parse_address(columns[1]) if len(columns) > 2 else None
+                country_acronym = columns[2].strip().strip('"').lower() if end else ""
+
+                try:
+                    latitude = float(columns[3]) if len(columns) > 4 else 0.0
+                    longitude = float(columns[4]) if len(columns) > 4 else 0.0
+                except ValueError:
+                    start = None
+
+                if (
+                    start is None
+                    or end is None
+                    or start[0] != end[0]
+                    or country_acronym not in COUNTRY_CODES
+                ):
+                    warning(f"Skipping malformed geolocation row {line_number}.")
+                    continue
+
+                if country_acronym not in acronyms:
+                    acronyms[country_acronym] = len(self._acronyms)
+                    self._acronyms.append(country_acronym)
+
+                row = len(self._countries)
+                self._countries.append(acronyms[country_acronym])
+                self._latitudes.append(latitude)
+                self._longitudes.append(longitude)
+                ranges[start[0]].append((start[1], end[1], row))
+
+        for version, family_ranges in ranges.items():
+            family_ranges.sort()
+
+            starts = self._v4_starts if version == 4 else self._v6_starts
+            ends = self._v4_ends if version == 4 else self._v6_ends
+            rows = self._v4_rows if version == 4 else self._v6_rows
+            for start, end, row in family_ranges:
+                starts.append(start)
+                ends.append(end)
+                rows.append(row)
+
+        info(f"Loaded {len(self)} IP ranges for offline geolocation.")
+
+    def lookup(self, address: str) -> UserGeolocalisation | None:
+        parsed = self._parse_address(address)
+        if parsed is None:
+            return None
+
+        version, ip = parsed
+        if version == 4:
+            starts, ends, rows = self._v4_starts, self._v4_ends, self._v4_rows
+        else:
+            starts, ends, rows = self._v6_starts, self._v6_ends, self._v6_rows
+
+        index = bisect.bisect_right(starts, ip) - 1
+        if index < 0 or ip > ends[index]:
+            return None
+
+        row = rows[index]
+        country_acronym = self._acronyms[self._countries[row]]
+        return UserGeolocalisation(
+            country_acronym=country_acronym,
+            country_code=COUNTRY_CODES[country_acronym],
+            latitude=self._latitudes[row],
+            longitude=self._longitudes[row],
+        )
+
+
+ip_range_database = IPRangeDatabase()
+
+
+async def fetch_ip_api_geolocalisation(ip: str | None) -> UserGeolocalisation | None:
+    if ip is None:
         url = "http://ip-api.com/json"
     else:
         url = f"http://ip-api.com/json/{ip}"
 
-    response = await http_client.get(
-        url,
-        query_params={"fields": "status,countryCode,lat,lon"},
-    )
-    json_data = response.json()
-
-    if json_data["status"] == "fail":
-        return UserGeolocalisation(  # Mumbai, India.
-            country_acronym="in",
-            country_code=COUNTRY_CODES["in"],
-            latitude=19.0760,
-            longitude=72.7777,  # Fixed this.
+    try:
+        response = await http_client.get(
+            url,
+            query_params={"fields": "status,countryCode,lat,lon"},
         )
+        json_data = response.json()
+    except (OSError, TimeoutError, ValueError) as exc:
+        warning(f"Geolocation lookup for {ip} failed: {exc!r}")
+        return None
+
+    if not isinstance(json_data, dict) or json_data.get("status") != "success":
+        return None
+
+    # Anything malformed is treated like a failed lookup and cached as such.
+    country_code = json_data.get("countryCode")
+    latitude = json_data.get("lat")
+    longitude = json_data.get("lon")
+    if (
+        not isinstance(country_code, str)
+        or not isinstance(latitude, (int, float))
+        or not isinstance(longitude, (int, float))
+    ):
+        warning(f"Geolocation lookup for {ip} returned a malformed reply.")
+        return None
+
+    country_acronym = country_code.lower()
+    if country_acronym not in COUNTRY_CODES:
+        return None
 
-    country_acronym = json_data["countryCode"].lower()
     return UserGeolocalisation(
         country_acronym=country_acronym,
         country_code=COUNTRY_CODES[country_acronym],
-        latitude=json_data["lat"],
-        longitude=json_data["lon"],
+        latitude=float(latitude),
+        longitude=float(longitude),
     )
 
 
+def peek_user_geolocalisation(ip: str | None) -> UserGeolocalisation | None:
+    # Only answers from sources that don't need to wait on anything.
+    if ip in ("127.0.0.1", "localhost"):
+        ip = None
+
+    if ip is not None and len(ip_range_database):
+        geoloc = ip_range_database.lookup(ip)
+        if geoloc is not None:
+            geolocation_lookups_total.inc("offline")
+            return geoloc
+
+    if not SETTING_GEOLOCATION_NETWORK:
+        return FALLBACK_GEOLOCALISATION
+
+    found, geoloc = geolocation_cache.get(ip or "")
+    if not found:
+        return None
+
+    geolocation_lookups_total.inc("hit" if geoloc is not None else "negative")
+    return geoloc if geoloc is not None else FALLBACK_GEOLOCALISATION
+
+
+async def get_user_geolocalisation(ip: str | None) -> UserGeolocalisation:
+    geoloc = peek_user_geolocalisation(ip)
+    if geoloc is not None:
+        return geoloc
+
+    if ip in ("127.0.0.1", "localhost"):
+        ip = None
+
+    # The server's own address is looked up for local clients.
+    geoloc = await geolocation_cache.lookup(
+        ip or "", lambda: fetch_ip_api_geolocalisation(ip)
+    )
+    if geoloc is None:
+        return FALLBACK_GEOLOCALISATION
+
+    return geoloc
+
+
 def check_password(password: str, db_password: str) -> bool:
     # Since for now we are using md5, we can just compare them.
     return password == db_password
@@ -1288,13 +3180,149 @@ def check_password(password: str, db_password: str) -> bool:
 
 ByteLike = bytes | bytearray
 
+PACKET_HEADER = struct.Struct("<HxI")
+PACKET_HEADER_PLACEHOLDER = bytes(PACKET_HEADER.size)
+PACKET_FIELD_FORMATS = {
+    "i8": "b",
+    "u8": "B",
+    "i16": "h",
+    "u16": "H",
+    "i32": "i",
+    "u32": "I",
+    "i64": "q",
+    "u64": "Q",
+    "f32": "f",
+}
+
+
+def encode_packet_str(value: str) -> bytes:
+    # Exists byte.
+    if not value:
+        return b"\x00"
+
+    data = value.encode("utf-8", "ignore")
+    length = len(data)
+    if length < 0x80:
+        return b"\x0b" + length.to_bytes() + data
+
+    prefix = bytearray(b"\x0b")
+    while length >= 0x80:
+        prefix.append((length & 0x7F) | 0x80)
+        length >>= 7
+    prefix.append(length)
+
+    return bytes(prefix) + data
+
+
+class PacketLayout:
+    # Consecutive fixed size fields are compiled into a single `struct.Struct`,
+    # so building a packet is one `pack_into` per run instead of a call per field.
+    __slots__ = (
+        "packet_id",
+        "_packet_id_value",
+        "_packet_name",
+        "_steps",
+        "_string_indices",
+        "_fixed_size",
+        "_field_count",
+    )
+
+    def __init__(self, packet_id: BanchoPacketID, *fields: str) -> None:
+        self.packet_id = packet_id
+        self._packet_id_value = packet_id.value
+        self._packet_name = packet_id.name
+        self._field_count = len(fields)
+
+        # (compiled run or None for a string, first value index, end value index)
+        self._steps: list[tuple[struct.Struct | None, int, int]] = []
+
+        run = ""
+        run_start = 0
+        for index, field_type in enumerate(fields):
+            if field_type == "str":
+                if run:
+                    self._steps.append((struct.Struct("<" + run), run_start, index))
+                    run = ""
+
+                self._steps.append((None, index, index + 1))
+                continue
+
+            if field_type not in PACKET_FIELD_FORMATS:
+                raise ValueError(f"Unknown packet field type {field_type!r}.")
+
+            if not run:
+                run_start = index
+            run += PACKET_FIELD_FORMATS[field_type]
+
+        if run:
+            self._steps.append((struct.Struct("<" + run), run_start, len(fields)))
+
+        self._string_indices = tuple(
+            start for step, start, _ in self._steps if step is None
+        )
+        self._fixed_size = sum(step.size for step, _, _ in self._steps if step)
+
+    def pack(self, *values: Any) -> bytearray:
+        return self._write(None, values)
+
+    def write_into(self, buffer: bytearray, *values: Any) -> bytearray:
+        # Appends the packet to `buffer`, which may already hold other packets.
+        return self._write(buffer, values)
+
+    def _write(self, buffer: bytearray | None, values: tuple[Any, ...]) -> bytearray:
+        if len(values) != self._field_count:
+            raise TypeError(
+                f"{self._packet_name} takes {self._field_count} values, got {len(values)}."
+            )
+
+        strings = [encode_packet_str(values[index]) for index in self._string_indices]
+        body_size = self._fixed_size + sum(map(len, strings))
+
+        if buffer is None:
+            offset = 0
+            buffer = bytearray(PACKET_HEADER.size + body_size)
+        else:
+            offset = len(buffer)
+            buffer += bytes(PACKET_HEADER.size + body_size)
+
+        PACKET_HEADER.pack_into(buffer, offset, self._packet_id_value, body_size)
+        offset += PACKET_HEADER.size
+
+        next_string = iter(strings).__next__
+        for step, first, last in self._steps:
+            if step is None:
+                data = next_string()
+                buffer[offset : offset + len(data)] = data
+                offset += len(data)
+            else:
+                step.pack_into(buffer, offset, *values[first:last])
+                offset += step.size
+
+        packets_total.inc("out", self._packet_name)
+        return buffer
+
+
+I16 = struct.Struct("<h")
+U16 = struct.Struct("<H")
+I32 = struct.Struct("<i")
+U32 = struct.Struct("<I")
+I64 = struct.Struct("<q")
+U64 = struct.Struct("<Q")
+F32 = struct.Struct("<f")
+
 
 class PacketWriter:
-    __slots__ = ("_packet_id", "_buf")
+    # The header is reserved up front and patched in `finish`, so the body never
+    # has to be copied behind it. Passing `buffer` appends the packet to it.
+    __slots__ = ("_packet_id", "_buf", "_start")
 
-    def __init__(self, packet_id: BanchoPacketID) -> None:
+    def __init__(
+        self, packet_id: BanchoPacketID, buffer: bytearray | None = None
+    ) -> None:
         self._packet_id = packet_id
-        self._buf = bytearray()
+        self._buf = buffer if buffer is not None else bytearray()
+        self._start = len(self._buf)
+        self._buf += PACKET_HEADER_PLACEHOLDER
 
     def write_i8(self, value: int) -> PacketWriter:
         self._buf.append(value)
@@ -1305,35 +3333,35 @@ class PacketWriter:
         return self
 
     def write_i16(self, value: int) -> PacketWriter:
-        self._buf.extend(struct.pack("<h", value))
+        self._buf += I16.pack(value)
         return self
 
     def write_u16(self, value: int) -> PacketWriter:
-        self._buf.extend(struct.pack("<H", value))
+        self._buf += U16.pack(value)
         return self
 
     def write_i32(self, value: int) -> PacketWriter:
-        self._buf.extend(struct.pack("<i", value))
+        self._buf += I32.pack(value)
         return self
 
     def write_u32(self, value: int) -> PacketWriter:
-        self._buf.extend(struct.pack("<I", value))
+        self._buf += U32.pack(value)
         return self
 
     def write_i64(self, value: int) -> PacketWriter:
-        self._buf.extend(struct.pack("<q", value))
+        self._buf += I64.pack(value)
         return self
 
     def write_u64(self, value: int) -> PacketWriter:
-        self._buf.extend(struct.pack("<Q", value))
+        self._buf += U64.pack(value)
         return self
 
     def write_f32(self, value: float) -> PacketWriter:
-        self._buf.extend(struct.pack("<f", value))
+        self._buf += F32.pack(value)
         return self
 
-    def write_raw(self, value: bytes) -> PacketWriter:
-        self._buf.extend(value)
+    def write_raw(self, value: ByteLike) -> PacketWriter:
+        self._buf += value
         return self
 
     def write_uleb128(self, value: int) -> PacketWriter:
@@ -1344,35 +3372,63 @@ class PacketWriter:
         return self
 
     def write_str(self, value: str) -> PacketWriter:
-        # Exists byte.
-        if not value:
-            self.write_i8(0)
-            return self
-
-        self.write_i8(0xB)
-        data = value.encode("utf-8", "ignore")
-        self.write_uleb128(len(data))
-        self._buf.extend(data)
+        self._buf += encode_packet_str(value)
         return self
 
     def write_list(self, values: list[int]) -> PacketWriter:
-        self.write_u16(len(values))
-        for value in values:
-            self.write_i32(value)
+        self._buf += U16.pack(len(values))
+        self._buf += struct.pack(f"<{len(values)}i", *values)
         return self
 
     def finish(self) -> bytearray:
-        packet_bytes = bytearray()
+        packets_total.inc("out", self._packet_id.name)
+
+        body_size = len(self._buf) - self._start - PACKET_HEADER.size
+        PACKET_HEADER.pack_into(
+            self._buf, self._start, self._packet_id.value, body_size
+        )
+
+        return self._buf
+
+
+# Unknown IDs stay plain ints, newer clients send packets we don't know about.
+PACKET_IDS: dict[int, BanchoPacketID] = {
+    packet_id.value: packet_id for packet_id in BanchoPacketID
+}
+
+
+def packet_name(packet_id: int) -> str:
+    known_id = PACKET_IDS.get(packet_id)
+    return known_id.name if known_id is not None else "UNKNOWN"
 
-        packet_bytes += struct.pack("<h", self._packet_id.value)
-        packet_bytes += b"\x00"
-        packet_bytes += struct.pack("<l", len(self._buf))
-        packet_bytes += self._buf
 
-        return packet_bytes
+def decode_packet_str(view: memoryview, pos: int) -> tuple[str, int]:
+    # Exists byte.
+    marker = view[pos]
+    pos += 1
+    if marker != 0xB:
+        return "", pos
+
+    length = 0
+    shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+
+    end = pos + length
+    if end > len(view):
+        raise IndexError("String runs past the end of the packet.")
+
+    return str(view[pos:end], "utf-8"), end
 
 
 class PacketReader:
+    # Reads straight out of a (usually bounded) memoryview, nothing is sliced
+    # or copied until a string or raw bytes are requested.
     __slots__ = (
         "_buf",
         "_pos",
@@ -1382,8 +3438,8 @@ class PacketReader:
     def empty(self) -> bool:
         return self._pos >= len(self._buf)
 
-    def __init__(self, buf: ByteLike) -> None:
-        self._buf = buf
+    def __init__(self, buf: ByteLike | memoryview) -> None:
+        self._buf = memoryview(buf)
         self._pos = 0
 
     def read_i8(self) -> int:
@@ -1397,37 +3453,37 @@ class PacketReader:
         return value
 
     def read_i16(self) -> int:
-        value = struct.unpack("<h", self._buf[self._pos : self._pos + 2])[0]
+        value = I16.unpack_from(self._buf, self._pos)[0]
         self._pos += 2
         return value
 
     def read_u16(self) -> int:
-        value = struct.unpack("<H", self._buf[self._pos : self._pos + 2])[0]
+        value = U16.unpack_from(self._buf, self._pos)[0]
         self._pos += 2
         return value
 
     def read_i32(self) -> int:
-        value = struct.unpack("<i", self._buf[self._pos : self._pos + 4])[0]
+        value = I32.unpack_from(self._buf, self._pos)[0]
         self._pos += 4
         return value
 
     def read_u32(self) -> int:
-        value = struct.unpack("<I", self._buf[self._pos : self._pos + 4])[0]
+        value = U32.unpack_from(self._buf, self._pos)[0]
         self._pos += 4
         return value
 
     def read_i64(self) -> int:
-        value = struct.unpack("<q", self._buf[self._pos : self._pos + 8])[0]
+        value = I64.unpack_from(self._buf, self._pos)[0]
         self._pos += 8
         return value
 
     def read_u64(self) -> int:
-        value = struct.unpack("<Q", self._buf[self._pos : self._pos + 8])[0]
+        value = U64.unpack_from(self._buf, self._pos)[0]
         self._pos += 8
         return value
 
     def read_f32(self) -> float:
-        value = struct.unpack("<f", self._buf[self._pos : self._pos + 4])[0]
+        value = F32.unpack_from(self._buf, self._pos)[0]
         self._pos += 4
         return value
 
@@ -1443,40 +3499,34 @@ class PacketReader:
             shift += 7
 
     def read_str(self) -> str:
-        if self.read_i8() != 0xB:
-            return ""
-
-        length = self.read_uleb128()
-        string = self._buf[self._pos : self._pos + length].decode()
-        self._pos += length
+        string, self._pos = decode_packet_str(self._buf, self._pos)
         return string
 
     def read_list(self) -> list[int]:
         length = self.read_u16()
-        return [self.read_i32() for _ in range(length)]
+        values = struct.unpack_from(f"<{length}i", self._buf, self._pos)
+        self._pos += length * 4
+        return list(values)
 
     def skip(self, length: int) -> None:
         self._pos += length
 
-    def read_header(self) -> tuple[BanchoPacketID, int]:
-        packet_id = BanchoPacketID(self.read_u16())
-        # Pad byte.
-        self.skip(1)
-        packet_length = self.read_u32()
-        return packet_id, packet_length
+    def read_record(self, schema: PacketSchema) -> Any:
+        record, self._pos = schema.decode_from(self._buf, self._pos)
+        return record
 
-    def remove_excess(self, packet_size: int) -> bytes:
-        excess = self._buf[self._pos + packet_size :]
-        self._buf = self._buf[: self._pos + packet_size]
-        return excess
+    def read_header(self) -> tuple[BanchoPacketID | int, int]:
+        packet_id, packet_length = PACKET_HEADER.unpack_from(self._buf, self._pos)
+        self._pos += PACKET_HEADER.size
+        return PACKET_IDS.get(packet_id, packet_id), packet_length
 
     def read_remaining_bytes(self) -> bytes:
-        return self._buf[self._pos :]
+        return self._buf[self._pos :].tobytes()
 
     def __iter__(self) -> PacketReader:
         return self
 
-    def __next__(self) -> tuple[BanchoPacketID, int]:
+    def __next__(self) -> tuple[BanchoPacketID | int, int]:
         if self.empty:
             raise StopIteration
         return self.read_header()
@@ -1484,234 +3534,600 @@ class PacketReader:
 
 @dataclass
 class PacketContext:
-    id: BanchoPacketID
+    id: BanchoPacketID | int
     length: int
     reader: PacketReader
 
     @staticmethod
     def create_from_buffers(buf: ByteLike) -> list[PacketContext]:
-        reader = PacketReader(buf)
+        # One pass over a single view, every packet gets a reader bounded to
+        # its own payload so handlers can't read into the next one.
+        view = memoryview(buf)
         ctxs: list[PacketContext] = []
 
-        while not reader.empty:
-            packet_id, length = reader.read_header()
-            ctxs.append(PacketContext(packet_id, length, reader))
-            reader = PacketReader(reader.remove_excess(length))
+        pos = 0
+        end = len(view)
+        while end - pos >= PACKET_HEADER.size:
+            packet_id, length = PACKET_HEADER.unpack_from(view, pos)
+            pos += PACKET_HEADER.size
+
+            ctxs.append(
+                PacketContext(
+                    PACKET_IDS.get(packet_id, packet_id),
+                    length,
+                    PacketReader(view[pos : pos + length]),
+                )
+            )
+            pos += length
 
         return ctxs
 
 
-PacketHandler = Callable[[PacketReader, "User"], Awaitable[None]]
+class PacketDecodeError(ValueError):
+    pass
+
+
+class EnumConverter:
+    # Enum construction goes through the metaclass and is surprisingly slow,
+    # so seen values are looked up in a plain dict instead.
+    __slots__ = ("_enum", "_members")
+
+    MAX_CACHED = 4096
+
+    def __init__(self, enum: type[Enum]) -> None:
+        self._enum = enum
+        self._members: dict[Any, Enum] = {member.value: member for member in enum}
+
+    def __call__(self, value: Any) -> Enum:
+        member = self._members.get(value)
+        if member is None:
+            member = self._enum(value)
+            if len(self._members) < self.MAX_CACHED:
+                self._members[value] = member
+
+        return member
+
+
+class PacketSchema:
+    # The inbound counterpart of `PacketLayout`. Wire types are given in the
+    # order of the record's fields, fields annotated with an enum are converted.
+    __slots__ = ("record", "wire_types", "_steps", "_converters")
+
+    FIXED = 0
+    STR = 1
+    LIST = 2
+    RAW = 3
+    VARIABLE_STEPS = {"str": STR, "list": LIST, "raw": RAW}
+
+    def __init__(self, record: type[tuple], *wire_types: str) -> None:
+        fields = record._fields  # type: ignore
+        if len(fields) != len(wire_types):
+            raise ValueError(f"{record.__name__} has {len(fields)} fields.")
+
+        self.record = record
+        self.wire_types = wire_types
+
+        # (step kind, compiled run for fixed fields)
+        self._steps: list[tuple[int, struct.Struct | None]] = []
+
+        run = ""
+        for wire_type in wire_types:
+            if wire_type in self.VARIABLE_STEPS:
+                if run:
+                    self._steps.append((self.FIXED, struct.Struct("<" + run)))
+                    run = ""
+
+                self._steps.append((self.VARIABLE_STEPS[wire_type], None))
+                continue
+
+            if wire_type not in PACKET_FIELD_FORMATS:
+                raise ValueError(f"Unknown packet field type {wire_type!r}.")
+
+            run += PACKET_FIELD_FORMATS[wire_type]
+
+        if run:
+            self._steps.append((self.FIXED, struct.Struct("<" + run)))
+
+        hints = get_type_hints(record)
+        self._converters = [
+            (index, EnumConverter(hints[name]))
+            for index, name in enumerate(fields)
+            if isinstance(hints[name], type) and issubclass(hints[name], Enum)
+        ]
+
+    def decode_from(self, view: memoryview, pos: int = 0) -> tuple[Any, int]:
+        values: list[Any] = []
+
+        try:
+            # Kinds are compared as plain ints, this loop runs for every packet.
+            for kind, step in self._steps:
+                if kind == 0:  # FIXED
+                    values += step.unpack_from(view, pos)  # type: ignore
+                    pos += step.size  # type: ignore
+                elif kind == 1:  # STR
+                    string, pos = decode_packet_str(view, pos)
+                    values.append(string)
+                elif kind == 2:  # LIST
+                    (length,) = U16.unpack_from(view, pos)
+                    values.append(
+                        list(struct.unpack_from(f"<{length}i", view, pos + 2))
+                    )
+                    pos += 2 + length * 4
+                else:
+                    values.append(view[pos:].tobytes())
+                    pos = len(view)
+
+            for index, converter in self._converters:
+                values[index] = converter(values[index])
+        except (struct.error, IndexError, UnicodeDecodeError, ValueError) as exc:
+            raise PacketDecodeError(str(exc)) from None
+
+        return self.record(*values), pos
+
+
+PacketHandler = Callable[[Any, "User"], Awaitable[None]]
+
+
+class PacketTypeStats(NamedTuple):
+    packet: str
+    received: int
+    received_bytes: int
+    handled: int
+    handler_seconds: float
+    queued: int
+    queued_bytes: int
+
+
+class PacketStats:
+    # Per packet type instrumentation. When disabled the router and the queues
+    # only pay for the `enabled` check.
+    __slots__ = ("enabled",)
+
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+
+    def record_handled(self, name: str, length: int, duration: float) -> None:
+        packet_bytes_total.inc("in", name, amount=length)
+        packet_handler_seconds.observe(duration, name)
+
+    def record_queued(self, data: ByteLike) -> None:
+        # Queued data may hold several packets, the headers are enough to split it.
+        pos = 0
+        end = len(data)
+        while end - pos >= PACKET_HEADER.size:
+            packet_id, length = PACKET_HEADER.unpack_from(data, pos)
+            pos += PACKET_HEADER.size + length
+
+            name = packet_name(packet_id)
+            packets_queued_total.inc(name)
+            packet_bytes_total.inc("out", name, amount=length)
+
+    def snapshot(self) -> list[PacketTypeStats]:
+        # Sorted by the total time spent in handlers, the busiest first.
+        stats = [
+            PacketTypeStats(
+                packet=packet_id.name,
+                received=int(packets_total.get("in", packet_id.name)),
+                received_bytes=int(packet_bytes_total.get("in", packet_id.name)),
+                handled=packet_handler_seconds.get_count(packet_id.name),
+                handler_seconds=packet_handler_seconds.get_sum(packet_id.name),
+                queued=int(packets_queued_total.get(packet_id.name)),
+                queued_bytes=int(packet_bytes_total.get("out", packet_id.name)),
+            )
+            for packet_id in BanchoPacketID
+        ]
+
+        return sorted(
+            (stat for stat in stats if stat.received or stat.queued),
+            key=lambda stat: (stat.handler_seconds, stat.queued_bytes),
+            reverse=True,
+        )
+
+
+packet_stats = PacketStats(enabled=SETTING_PACKET_STATS_ENABLED)
 
 
 class PacketRouter:
-    __slots__ = ("_restricted_packets", "_handlers")
+    # Handlers live in flat lists indexed by the raw packet ID.
+    __slots__ = ("_allowed_restricted", "_handlers", "_schemas", "_reported_ids")
+
+    MAX_REPORTED_IDS = 256
 
     def __init__(self) -> None:
-        self._restricted_packets: list[int] = []
-        self._handlers: dict[BanchoPacketID, PacketHandler] = {}
+        size = max(BanchoPacketID) + 1
+        self._allowed_restricted: list[bool] = [False] * size
+        self._handlers: list[PacketHandler | None] = [None] * size
+        self._schemas: list[PacketSchema | None] = [None] * size
+        self._reported_ids: set[int] = set()
 
-    def add_handler(self, packet_id: BanchoPacketID, restricted=False) -> Callable:
+    def add_handler(
+        self,
+        packet_id: BanchoPacketID,
+        restricted=False,
+        schema: PacketSchema | None = None,
+    ) -> Callable:
+        # With a `schema` the handler gets the decoded record, otherwise the reader.
         def decorator(handler: PacketHandler) -> PacketHandler:
             self._handlers[packet_id] = handler
-
-            if restricted:
-                self._restricted_packets.append(packet_id.value)
+            self._allowed_restricted[packet_id] = restricted
+            self._schemas[packet_id] = schema
 
             return handler
 
         return decorator
 
+    def _drop(self, ctx: PacketContext, user: User, reason: str) -> None:
+        name = packet_name(ctx.id)
+        packets_dropped_total.inc(name, reason)
+
+        # Only the first sighting is logged, the metric has the totals.
+        if (
+            ctx.id in self._reported_ids
+            or len(self._reported_ids) >= self.MAX_REPORTED_IDS
+        ):
+            return
+
+        self._reported_ids.add(ctx.id)
+        warning(
+            f"Ignoring {reason} packet {name} ({int(ctx.id)}) first sent by "
+            f"{user.username} ({user.user_id})"
+        )
+
     async def route(self, ctx: PacketContext, user: User) -> None:
-        if ctx.id in self._handlers:
+        packet_id = ctx.id
+        handler = (
+            self._handlers[packet_id] if 0 <= packet_id < len(self._handlers) else None
+        )
+
+        if handler is None:
+            self._drop(ctx, user, "unhandled" if packet_id in PACKET_IDS else "unknown")
+            return
+
+        packets_total.inc("in", packet_id.name)  # type: ignore
+
+        if not self._allowed_restricted[packet_id] and user.restricted:
+            return
 
-            if not ctx.id.value in self._restricted_packets and user.restricted:
+        packet: Any = ctx.reader
+        schema = self._schemas[packet_id]
+        if schema is not None:
+            try:
+                packet = ctx.reader.read_record(schema)
+            except PacketDecodeError as exc:
+                # A single bad packet shouldn't take the rest of the poll with it.
+                packets_dropped_total.inc(packet_id.name, "malformed")  # type: ignore
+                debug(
+                    f"Dropped malformed {packet_id.name} from {user.username} "  # type: ignore
+                    f"({user.user_id}): {exc}"
+                )
                 return
 
-            await self._handlers[ctx.id](ctx.reader, user)
-        else:
-            warning(
-                f"Unhandled packet ID {ctx.id} from {user.username} ({user.user_id})"
+        if not packet_stats.enabled:
+            await handler(packet, user)
+            return
+
+        started_at = time.perf_counter()
+        try:
+            await handler(packet, user)
+        finally:
+            packet_stats.record_handled(
+                packet_id.name,  # type: ignore
+                ctx.length,
+                time.perf_counter() - started_at,
             )
 
 
-def bancho_notification_packet(message: str) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_NOTIFICATION)
-    packet.write_str(message)
-    return packet.finish()
+def _out(out: bytearray | None) -> bytearray:
+    # Builders take an optional shared buffer to append their packet to.
+    return out if out is not None else bytearray()
 
 
-def bancho_login_reply_packet(user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_LOGIN_REPLY)
-    packet.write_i32(user_id)
-    return packet.finish()
+NOTIFICATION_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_NOTIFICATION,
+    "str",
+)
 
 
-def bancho_logout_packet(user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_USER_LOGOUT)
-    packet.write_i32(user_id)
-    packet.write_u8(0)
-    return packet.finish()
+def bancho_notification_packet(message: str, out: bytearray | None = None) -> bytearray:
+    return NOTIFICATION_LAYOUT.write_into(_out(out), message)
 
 
-def bancho_protocol_packet() -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_PROTOCOL_VERSION)
-    packet.write_i32(19)
-    return packet.finish()
+LOGIN_REPLY_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_LOGIN_REPLY,
+    "i32",
+)
 
 
-def bancho_channel_info_packet(channel: BanchoChannel) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_CHANNEL_INFO)
-    packet.write_str(channel.name)
-    packet.write_str(channel.topic)
-    packet.write_u16(len(channel))
-    return packet.finish()
+def bancho_login_reply_packet(user_id: int, out: bytearray | None = None) -> bytearray:
+    return LOGIN_REPLY_LAYOUT.write_into(_out(out), user_id)
 
 
-def bancho_channel_join_success_packet(channel: BanchoChannel) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_CHANNEL_JOIN_SUCCESS)
-    packet.write_str(channel.name)
-    return packet.finish()
+LOGOUT_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_USER_LOGOUT,
+    "i32",
+    "u8",
+)
 
 
-def bancho_channel_kick_packet(channel: BanchoChannel) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_CHANNEL_KICK)
-    packet.write_str(channel.name)
-    return packet.finish()
+def bancho_logout_packet(user_id: int) -> bytearray:
+    return LOGOUT_LAYOUT.pack(user_id, 0)
 
 
-def bancho_channel_info_end_packet() -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_CHANNEL_INFO_END)
-    packet.write_u32(0)
-    return packet.finish()
+PROTOCOL_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_PROTOCOL_VERSION,
+    "i32",
+)
 
 
-def bancho_silence_end_packet(silence_end: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_SILENCE_END)
-    packet.write_u32(silence_end)
-    return packet.finish()
+def bancho_protocol_packet(out: bytearray | None = None) -> bytearray:
+    return PROTOCOL_LAYOUT.write_into(_out(out), 19)
 
 
-def bancho_login_perms_packet(privileges: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_PRIVILEGES)
-    packet.write_u32(privileges)
-    return packet.finish()
+CHANNEL_INFO_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_CHANNEL_INFO,
+    "str",
+    "str",
+    "u16",
+)
 
 
-def bancho_user_presence_packet(user: User) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_USER_PRESENCE)
-    packet.write_i32(user.user_id)
-    packet.write_str(user.username)
-    packet.write_u8(user.utc_offset + 24)
-    packet.write_u8(user.geoloc.country_code)
-    packet.write_u8(user.privileges)
-    packet.write_f32(user.geoloc.longitude)
-    packet.write_f32(user.geoloc.latitude)
-    packet.write_i32(user.current_stats.rank)
-    return packet.finish()
+def bancho_channel_info_packet(
+    channel: BanchoChannel, out: bytearray | None = None
+) -> bytearray:
+    return CHANNEL_INFO_LAYOUT.write_into(
+        _out(out), channel.name, channel.topic, len(channel)
+    )
 
 
-def bancho_user_stats_packet(user: User) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_USER_STATS)
-    packet.write_i32(user.user_id)
-    packet.write_u8(user.status.action.value)
-    packet.write_str(user.status.action_text)
-    packet.write_str(user.status.action_md5)
-    packet.write_i32(user.status.mods.value)
-    packet.write_u8(user.status.mode.value)
-    packet.write_i32(user.status.beatmap_id)
-    packet.write_i64(user.current_stats.ranked_score)
-    packet.write_f32(user.current_stats.accuracy / 100)
-    packet.write_i32(user.current_stats.playcount)
-    packet.write_i64(user.current_stats.total_score)
-    packet.write_i32(user.current_stats.rank)
-    packet.write_i32(user.current_stats.pp)
+CHANNEL_JOIN_SUCCESS_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_CHANNEL_JOIN_SUCCESS,
+    "str",
+)
 
-    return packet.finish()
+
+def bancho_channel_join_success_packet(channel: BanchoChannel) -> bytearray:
+    return CHANNEL_JOIN_SUCCESS_LAYOUT.pack(channel.name)
+
+
+CHANNEL_KICK_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_CHANNEL_KICK,
+    "str",
+)
+
+
+def bancho_channel_kick_packet(channel: BanchoChannel) -> bytearray:
+    return CHANNEL_KICK_LAYOUT.pack(channel.name)
 
 
-def bancho_user_friends_packet(friends_list: list[int]) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_FRIENDS_LIST)
+CHANNEL_INFO_END_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_CHANNEL_INFO_END,
+    "u32",
+)
+
+
+def bancho_channel_info_end_packet(out: bytearray | None = None) -> bytearray:
+    return CHANNEL_INFO_END_LAYOUT.write_into(_out(out), 0)
+
+
+SILENCE_END_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_SILENCE_END,
+    "u32",
+)
+
+
+def bancho_silence_end_packet(
+    silence_end: int, out: bytearray | None = None
+) -> bytearray:
+    return SILENCE_END_LAYOUT.write_into(_out(out), silence_end)
+
+
+PRIVILEGES_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_PRIVILEGES,
+    "u32",
+)
+
+
+def bancho_login_perms_packet(
+    privileges: int, out: bytearray | None = None
+) -> bytearray:
+    return PRIVILEGES_LAYOUT.write_into(_out(out), privileges)
+
+
+USER_PRESENCE_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_USER_PRESENCE,
+    "i32",  # user id
+    "str",  # username
+    "u8",  # utc offset
+    "u8",  # country code
+    "u8",  # privileges
+    "f32",  # longitude
+    "f32",  # latitude
+    "i32",  # rank
+)
+
+
+def bancho_user_presence_packet(user: User, out: bytearray | None = None) -> bytearray:
+    return USER_PRESENCE_LAYOUT.write_into(
+        _out(out),
+        user.user_id,
+        user.username,
+        user.utc_offset + 24,
+        user.geoloc.country_code,
+        user.privileges,
+        user.geoloc.longitude,
+        user.geoloc.latitude,
+        user.current_stats.rank,
+    )
+
+
+USER_STATS_LAYOUT = PacketLayout(
+    BanchoPacketID.SRV_USER_STATS,
+    "i32",  # user id
+    "u8",  # action
+    "str",  # action text
+    "str",  # beatmap md5
+    "i32",  # mods
+    "u8",  # mode
+    "i32",  # beatmap id
+    "i64",  # ranked score
+    "f32",  # accuracy
+    "i32",  # playcount
+    "i64",  # total score
+    "i32",  # rank
+    "i32",  # pp
+)
+
+
+def bancho_user_stats_packet(user: User, out: bytearray | None = None) -> bytearray:
+    return USER_STATS_LAYOUT.write_into(
+        _out(out),
+        user.user_id,
+        user.status.action.value,
+        user.status.action_text,
+        user.status.action_md5,
+        user.status.mods.value,
+        user.status.mode.value,
+        user.status.beatmap_id,
+        user.current_stats.ranked_score,
+        user.current_stats.accuracy / 100,
+        user.current_stats.playcount,
+        user.current_stats.total_score,
+        user.current_stats.rank,
+        user.current_stats.pp,
+    )
+
+
+def bancho_user_friends_packet(
+    friends_list: list[int], out: bytearray | None = None
+) -> bytearray:
+    packet = PacketWriter(BanchoPacketID.SRV_FRIENDS_LIST, out)
     packet.write_list(friends_list)
     return packet.finish()
 
 
-def bancho_user_dm_blocked_packet(username: str) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_USER_DM_BLOCKED)
-    packet.write_str("")
-    packet.write_str("")
-    packet.write_str(username)
-    packet.write_i32(0)
-    return packet.finish()
+# Chat messages, DM blocked and target silenced notices share a layout.
+MESSAGE_LAYOUTS = {
+    packet_id: PacketLayout(packet_id, "str", "str", "str", "i32")
+    for packet_id in (
+        BanchoPacketID.SRV_USER_DM_BLOCKED,
+        BanchoPacketID.SRV_TARGET_IS_SILENCED,
+        BanchoPacketID.SRV_SEND_MESSAGE,
+    )
+}
 
 
-def bancho_user_silenced_packet(username: str) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_TARGET_IS_SILENCED)
-    packet.write_str("")
-    packet.write_str("")
-    packet.write_str(username)
-    packet.write_i32(0)
-    return packet.finish()
+def bancho_user_dm_blocked_packet(username: str) -> bytearray:
+    return MESSAGE_LAYOUTS[BanchoPacketID.SRV_USER_DM_BLOCKED].pack("", "", username, 0)
+
+
+def bancho_user_silenced_packet(username: str) -> bytearray:
+    return MESSAGE_LAYOUTS[BanchoPacketID.SRV_TARGET_IS_SILENCED].pack(
+        "", "", username, 0
+    )
 
 
 def bancho_send_message_packet(
     sender: str, message: str, recipient: str, sender_id: int
-) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_SEND_MESSAGE)
-    packet.write_str(sender)
-    packet.write_str(message)
-    packet.write_str(recipient)
-    packet.write_i32(sender_id)
-    return packet.finish()
+) -> bytearray:
+    return MESSAGE_LAYOUTS[BanchoPacketID.SRV_SEND_MESSAGE].pack(
+        sender, message, recipient, sender_id
+    )
 
 
-def bancho_server_restart_packet(ms: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_RESTART)
-    packet.write_i32(ms)
-    return packet.finish()
+# Packets which only carry a single i32.
+I32_LAYOUTS = {
+    packet_id: PacketLayout(packet_id, "i32")
+    for packet_id in (
+        BanchoPacketID.SRV_RESTART,
+        BanchoPacketID.SRV_FELLOW_SPECTATOR_JOINED,
+        BanchoPacketID.SRV_FELLOW_SPECTATOR_LEFT,
+        BanchoPacketID.SRV_SPECTATOR_JOINED,
+        BanchoPacketID.SRV_SPECTATOR_LEFT,
+        BanchoPacketID.SRV_SPECTATOR_CANT_SPECTATE,
+    )
+}
 
 
-def bancho_join_watch_party(user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_FELLOW_SPECTATOR_JOINED)
-    packet.write_i32(user_id)
-    return packet.finish()
+def bancho_server_restart_packet(ms: int, out: bytearray | None = None) -> bytearray:
+    return I32_LAYOUTS[BanchoPacketID.SRV_RESTART].write_into(_out(out), ms)
 
 
-def bancho_leave_watch_party(user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_FELLOW_SPECTATOR_LEFT)
-    packet.write_i32(user_id)
-    return packet.finish()
+def bancho_join_watch_party(user_id: int) -> bytearray:
+    return I32_LAYOUTS[BanchoPacketID.SRV_FELLOW_SPECTATOR_JOINED].pack(user_id)
 
 
-def bancho_watch_party_joined_host(user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_SPECTATOR_JOINED)
-    packet.write_i32(user_id)
-    return packet.finish()
+def bancho_leave_watch_party(user_id: int) -> bytearray:
+    return I32_LAYOUTS[BanchoPacketID.SRV_FELLOW_SPECTATOR_LEFT].pack(user_id)
 
 
-def bancho_watch_party_left_host(user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_SPECTATOR_LEFT)
-    packet.write_i32(user_id)
-    return packet.finish()
+def bancho_watch_party_joined_host(user_id: int) -> bytearray:
+    return I32_LAYOUTS[BanchoPacketID.SRV_SPECTATOR_JOINED].pack(user_id)
 
 
-def bancho_watch_party_no_maidens(user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_SPECTATOR_CANT_SPECTATE)
-    packet.write_i32(user_id)
-    return packet.finish()
+def bancho_watch_party_left_host(user_id: int) -> bytearray:
+    return I32_LAYOUTS[BanchoPacketID.SRV_SPECTATOR_LEFT].pack(user_id)
+
+
+def bancho_watch_party_no_maidens(user_id: int) -> bytearray:
+    return I32_LAYOUTS[BanchoPacketID.SRV_SPECTATOR_CANT_SPECTATE].pack(user_id)
 
 
 # TODO: Actually bother building this and maybe do realtime PP :eyes:
-def bancho_spectate_frames(frame_data: bytes) -> bytes:
+def bancho_spectate_frames(frame_data: bytes) -> bytearray:
     packet = PacketWriter(BanchoPacketID.SRV_SPECTATE_FRAMES)
     packet.write_raw(frame_data)
     return packet.finish()
 
 
-def bancho_spectate_no_beatmap_notify(lame_user_id: int) -> bytes:
-    packet = PacketWriter(BanchoPacketID.SRV_SPECTATOR_CANT_SPECTATE)
-    packet.write_i32(lame_user_id)
-    return packet.finish()
+def bancho_spectate_no_beatmap_notify(lame_user_id: int) -> bytearray:
+    return I32_LAYOUTS[BanchoPacketID.SRV_SPECTATOR_CANT_SPECTATE].pack(lame_user_id)
+
+
+class ChangeActionPacket(NamedTuple):
+    action: BanchoAction
+    action_text: str
+    action_md5: str
+    mods: OsuMods
+    mode: OsuMode
+    beatmap_id: int
+
+
+class UserIDListPacket(NamedTuple):
+    user_ids: list[int]
+
+
+class UserIDPacket(NamedTuple):
+    user_id: int
+
+
+class ChannelPacket(NamedTuple):
+    channel_name: str
+
+
+class ValuePacket(NamedTuple):
+    value: int
+
+
+class MessagePacket(NamedTuple):
+    sender: str
+    message: str
+    recipient: str
+    sender_id: int
+
+
+class SpectateFramesPacket(NamedTuple):
+    frame_data: bytes
+
+
+CHANGE_ACTION_SCHEMA = PacketSchema(
+    ChangeActionPacket, "u8", "str", "str", "i32", "u8", "i32"
+)
+USER_ID_LIST_SCHEMA = PacketSchema(UserIDListPacket, "list")
+USER_ID_SCHEMA = PacketSchema(UserIDPacket, "i32")
+CHANNEL_SCHEMA = PacketSchema(ChannelPacket, "str")
+VALUE_SCHEMA = PacketSchema(ValuePacket, "i32")
+MESSAGE_SCHEMA = PacketSchema(MessagePacket, "str", "str", "str", "i32")
+SPECTATE_FRAMES_SCHEMA = PacketSchema(SpectateFramesPacket, "raw")
 
 
 packets_router = PacketRouter()
@@ -1722,31 +4138,38 @@ async def bancho_heartbeat_handler(reader: PacketReader, user: User) -> None:
     pass
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_CHANGE_ACTION, restricted=True)
-async def bancho_change_action_handler(reader: PacketReader, user: User) -> None:
-    user.status.action = BanchoAction(reader.read_u8())
-    user.status.action_text = reader.read_str()
-    user.status.action_md5 = reader.read_str()
-    user.status.mods = OsuMods(reader.read_i32())
-    user.status.mode = OsuMode(reader.read_u8())
-    user.status.beatmap_id = reader.read_i32()
+@packets_router.add_handler(
+    BanchoPacketID.OSU_CHANGE_ACTION, restricted=True, schema=CHANGE_ACTION_SCHEMA
+)
+async def bancho_change_action_handler(packet: ChangeActionPacket, user: User) -> None:
+    user.status.action = packet.action
+    user.status.action_text = packet.action_text
+    user.status.action_md5 = packet.action_md5
+    user.status.mods = packet.mods
+    user.status.mode = packet.mode
+    user.status.beatmap_id = packet.beatmap_id
+
+    # The rank in the presence depends on the mode.
+    user.invalidate_packets()
 
     if not user.restricted:
-        broadcast_to_online_users(bancho_user_stats_packet(user))
+        broadcast_to_online_users(user.stats_packet())
 
 
 @packets_router.add_handler(BanchoPacketID.OSU_REQUEST_STATUS_UPDATE, restricted=True)
 async def bancho_request_status_update_handler(
     reader: PacketReader, user: User
 ) -> None:
-    user.enqueue(bancho_user_stats_packet(user))
-
+    user.enqueue(user.stats_packet())
 
-@packets_router.add_handler(BanchoPacketID.OSU_USER_STATS_REQUEST, restricted=True)
-async def bancho_user_stats_request_handler(reader: PacketReader, user: User) -> None:
-    user_ids = reader.read_list()
 
-    for user_id in filter(lambda x: x != user.user_id, user_ids):
+@packets_router.add_handler(
+    BanchoPacketID.OSU_USER_STATS_REQUEST, restricted=True, schema=USER_ID_LIST_SCHEMA
+)
+async def bancho_user_stats_request_handler(
+    packet: UserIDListPacket, user: User
+) -> None:
+    for user_id in filter(lambda x: x != user.user_id, packet.user_ids):
         token = user_id_to_token.get(user_id)
         if token is None:
             continue
@@ -1758,16 +4181,16 @@ async def bancho_user_stats_request_handler(reader: PacketReader, user: User) ->
         if requested_user.restricted:
             continue
 
-        user.enqueue(bancho_user_stats_packet(requested_user))
+        user.enqueue(requested_user.stats_packet())
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_USER_PRESENCE_REQUEST)
+@packets_router.add_handler(
+    BanchoPacketID.OSU_USER_PRESENCE_REQUEST, schema=USER_ID_LIST_SCHEMA
+)
 async def bancho_user_presence_request_handler(
-    reader: PacketReader, user: User
+    packet: UserIDListPacket, user: User
 ) -> None:
-    user_ids = reader.read_list()
-
-    for user_id in user_ids:
+    for user_id in packet.user_ids:
         token = user_id_to_token.get(user_id)
         if token is None:
             continue
@@ -1776,26 +4199,21 @@ async def bancho_user_presence_request_handler(
         if requested_user is None:
             continue
 
-        user.enqueue(bancho_user_presence_packet(requested_user))
+        user.enqueue(requested_user.presence_packet())
 
 
 @packets_router.add_handler(BanchoPacketID.OSU_USER_PRESENCE_REQUEST_ALL)
 async def bancho_user_stats_request_all_handler(
     reader: PacketReader, user: User
 ) -> None:
-    buffer = bytearray()
-    for online_user in users.values():
-        if online_user.restricted:
-            continue
-
-        buffer += bancho_user_presence_packet(online_user)
-
-    user.enqueue(bytes(buffer))
+    user.enqueue(online_presences.presences())
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_CHANNEL_JOIN, restricted=True)
-async def bancho_channel_join_handler(reader: PacketReader, user: User) -> None:
-    channel_name = reader.read_str()
+@packets_router.add_handler(
+    BanchoPacketID.OSU_CHANNEL_JOIN, restricted=True, schema=CHANNEL_SCHEMA
+)
+async def bancho_channel_join_handler(packet: ChannelPacket, user: User) -> None:
+    channel_name = packet.channel_name
 
     if not channel_name.startswith("#"):
         return
@@ -1809,9 +4227,11 @@ async def bancho_channel_join_handler(reader: PacketReader, user: User) -> None:
 IGNORED_CHANNELS = ["#userlog"]
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_CHANNEL_PART, restricted=True)
-async def bancho_channel_part_handler(reader: PacketReader, user: User) -> None:
-    channel_name = reader.read_str()
+@packets_router.add_handler(
+    BanchoPacketID.OSU_CHANNEL_PART, restricted=True, schema=CHANNEL_SCHEMA
+)
+async def bancho_channel_part_handler(packet: ChannelPacket, user: User) -> None:
+    channel_name = packet.channel_name
 
     if not channel_name.startswith("#"):
         return
@@ -1839,17 +4259,18 @@ async def bancho_receive_updates_handler(reader: PacketReader, user: User) -> No
     pass  # client does that automatically
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_TOGGLE_BLOCK_NON_FRIEND_DMS)
+@packets_router.add_handler(
+    BanchoPacketID.OSU_TOGGLE_BLOCK_NON_FRIEND_DMS, schema=VALUE_SCHEMA
+)
 async def bancho_toggle_block_non_friend_dms_handler(
-    reader: PacketReader, user: User
+    packet: ValuePacket, user: User
 ) -> None:
-    value = reader.read_i32()
-    user.pm_private = value == 1
+    user.pm_private = packet.value == 1
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_FRIEND_ADD)
-async def bancho_friend_add_handler(reader: PacketReader, user: User) -> None:
-    user_id = reader.read_i32()
+@packets_router.add_handler(BanchoPacketID.OSU_FRIEND_ADD, schema=USER_ID_SCHEMA)
+async def bancho_friend_add_handler(packet: UserIDPacket, user: User) -> None:
+    user_id = packet.user_id
 
     token = user_id_to_token.get(user_id)
     if token is None:
@@ -1872,9 +4293,9 @@ async def bancho_friend_add_handler(reader: PacketReader, user: User) -> None:
     user.add_friend(user_id)
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_FRIEND_REMOVE)
-async def bancho_friend_remove_handler(reader: PacketReader, user: User) -> None:
-    user_id = reader.read_i32()
+@packets_router.add_handler(BanchoPacketID.OSU_FRIEND_REMOVE, schema=USER_ID_SCHEMA)
+async def bancho_friend_remove_handler(packet: UserIDPacket, user: User) -> None:
+    user_id = packet.user_id
 
     token = user_id_to_token.get(user_id)
     if token is None:
@@ -1906,12 +4327,14 @@ async def bancho_part_lobby_handler(reader: PacketReader, user: User) -> None:
     user.in_lobby = False
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_SEND_PRIVATE_MESSAGE)
-async def bancho_send_private_message_handler(reader: PacketReader, user: User) -> None:
-    reader.read_str()
-    message = reader.read_str()
-    recipient = reader.read_str()
-    reader.read_i32()
+@packets_router.add_handler(
+    BanchoPacketID.OSU_SEND_PRIVATE_MESSAGE, schema=MESSAGE_SCHEMA
+)
+async def bancho_send_private_message_handler(
+    packet: MessagePacket, user: User
+) -> None:
+    message = packet.message
+    recipient = packet.recipient
 
     if user.silenced:
         return
@@ -1963,12 +4386,12 @@ async def bancho_send_private_message_handler(reader: PacketReader, user: User)
     user.update_user()
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_SEND_PUBLIC_MESSAGE)
-async def bancho_send_public_message_handler(reader: PacketReader, user: User) -> None:
-    reader.read_str()
-    message = reader.read_str()
-    recipient = reader.read_str()
-    reader.read_i32()
+@packets_router.add_handler(
+    BanchoPacketID.OSU_SEND_PUBLIC_MESSAGE, schema=MESSAGE_SCHEMA
+)
+async def bancho_send_public_message_handler(packet: MessagePacket, user: User) -> None:
+    message = packet.message
+    recipient = packet.recipient
 
     if user.silenced:
         return
@@ -2021,9 +4444,9 @@ async def bancho_send_public_message_handler(reader: PacketReader, user: User) -
     user.update_user()
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_START_SPECTATING)
-async def bancho_start_spectating_handler(reader: PacketReader, user: User) -> None:
-    user_id = reader.read_i32()
+@packets_router.add_handler(BanchoPacketID.OSU_START_SPECTATING, schema=USER_ID_SCHEMA)
+async def bancho_start_spectating_handler(packet: UserIDPacket, user: User) -> None:
+    user_id = packet.user_id
 
     token = user_id_to_token.get(user_id)
     if token is None:
@@ -2052,9 +4475,13 @@ async def bancho_stop_spectating_handler(reader: PacketReader, user: User) -> No
     user.watch_party.the_watched.leave_watch_party(user)
 
 
-@packets_router.add_handler(BanchoPacketID.OSU_SPECTATE_FRAMES)
-async def bancho_spectate_frames_handler(reader: PacketReader, user: User) -> None:
-    frame_data = reader.read_remaining_bytes()
+@packets_router.add_handler(
+    BanchoPacketID.OSU_SPECTATE_FRAMES, schema=SPECTATE_FRAMES_SCHEMA
+)
+async def bancho_spectate_frames_handler(
+    packet: SpectateFramesPacket, user: User
+) -> None:
+    frame_data = packet.frame_data
 
     if user.watch_party is None:
         error(
@@ -2221,6 +4648,14 @@ class UserWatchParty:
             watcher.enqueue(packet)
 
 
+# Packets missing here are never dropped.
+QUEUE_POLICIES: dict[int, QueuePolicy] = {
+    BanchoPacketID.SRV_SPECTATE_FRAMES: QueuePolicy.DROP,
+    BanchoPacketID.SRV_USER_STATS: QueuePolicy.COALESCE,
+    BanchoPacketID.SRV_USER_PRESENCE: QueuePolicy.COALESCE,
+}
+
+
 @dataclass
 class User:
     user_id: int
@@ -2255,6 +4690,16 @@ class User:
 
     is_bot_client: bool = False
     _packet_queue: bytearray = field(default_factory=bytearray)
+    # Position in `broadcast_log`, None until the user is online.
+    _broadcast_cursor: int | None = field(default=None, repr=False)
+    # Size at which the queue gets compacted, see `_compact_queue`.
+    _queue_limit: int = field(default=SETTING_USER_QUEUE_LIMIT, repr=False)
+    # Monotonic time of the last poll, used by `SessionReaper`.
+    last_poll_at: float = field(default_factory=time.monotonic, repr=False)
+
+    # Encoded once and reused until `invalidate_packets` is called.
+    _presence_packet: bytes | None = field(default=None, repr=False)
+    _stats_packet: bytes | None = field(default=None, repr=False)
 
     @property
     def restricted(self) -> bool:
@@ -2279,6 +4724,8 @@ class User:
             assert record is not None
             self.stats[mode] = UserStatistics.from_model(record.result)
 
+        self.invalidate_packets()
+
     async def update_ranks(self) -> None:
         for mode in OsuMode:
             placement = leaderboards[mode].get_placement(self.user_id)
@@ -2287,6 +4734,8 @@ class User:
             else:
                 self.stats[mode].rank = 0
 
+        self.invalidate_packets()
+
     def fetch_friends_and_blocks_from_database(self) -> None:
         friends = user_relationship_db.query(
             lambda x: x.user_id == self.user_id
@@ -2302,20 +4751,120 @@ class User:
         self.friends = [1] + [record.result.friend_id for record in friends]
         self.blocks = [record.result.friend_id for record in blocks]
 
-    def presence_and_stats_packet(self) -> bytes:
-        return bancho_user_presence_packet(self) + bancho_user_stats_packet(self)
+    def presence_packet(self) -> bytes:
+        if self._presence_packet is None:
+            self._presence_packet = bytes(bancho_user_presence_packet(self))
+
+        return self._presence_packet
+
+    def stats_packet(self) -> bytes:
+        if self._stats_packet is None:
+            self._stats_packet = bytes(bancho_user_stats_packet(self))
+
+        return self._stats_packet
+
+    def presence_and_stats_packet(
+        self, out: bytearray | None = None
+    ) -> bytes | bytearray:
+        # Without `out` a new bytes object, otherwise `out` itself.
+        if out is None:
+            return self.presence_packet() + self.stats_packet()
+
+        out += self.presence_packet()
+        out += self.stats_packet()
+        return out
+
+    def invalidate_packets(self) -> None:
+        # Has to be called after changing the status, stats, rank, privileges or
+        # geolocation, otherwise clients keep getting the old packets.
+        self._stats_packet = None
+        self._presence_packet = None
+
+        online_presences.update(self)
 
     def update_user(self) -> None:
         self.latest_activity = int(time.time())
 
         update_user_in_database(self)
 
+    @property
+    def queued_bytes(self) -> int:
+        pending = 0
+        if self._broadcast_cursor is not None:
+            pending = broadcast_log.pending_bytes(self._broadcast_cursor)
+
+        return len(self._packet_queue) + pending
+
+    def _splice_broadcasts(self) -> None:
+        cursor = self._broadcast_cursor
+        if cursor is not None and cursor != broadcast_log.next_seq:
+            self._broadcast_cursor = broadcast_log.read_into(
+                self._packet_queue, cursor, self.user_id
+            )
+
+            if len(self._packet_queue) > self._queue_limit:
+                self._compact_queue()
+
+    def _compact_queue(self) -> None:
+        # Applies `QUEUE_POLICIES`: stale spectator frames are dropped and only
+        # the newest stats and presence of each user are kept. Everything else,
+        # chat included, is never dropped.
+        queue = memoryview(self._packet_queue)
+        packets: list[tuple[int, int, int, Any]] = []
+        latest: dict[Any, int] = {}
+
+        pos = 0
+        end = len(queue)
+        while end - pos >= PACKET_HEADER.size:
+            packet_id, length = PACKET_HEADER.unpack_from(queue, pos)
+            payload_start = pos + PACKET_HEADER.size
+            packet_end = payload_start + length
+
+            key = None
+            if QUEUE_POLICIES.get(packet_id) is QueuePolicy.COALESCE:
+                # Both start with the user ID.
+                key = (packet_id, queue[payload_start : payload_start + 4].tobytes())
+                latest[key] = pos
+
+            packets.append((packet_id, pos, packet_end, key))
+            pos = packet_end
+
+        compacted = bytearray()
+        for packet_id, start, packet_end, key in packets:
+            policy = QUEUE_POLICIES.get(packet_id, QueuePolicy.KEEP)
+
+            if policy is QueuePolicy.DROP:
+                queued_packets_dropped_total.inc(packet_name(packet_id), "stale")
+            elif policy is QueuePolicy.COALESCE and latest[key] != start:
+                queued_packets_dropped_total.inc(packet_name(packet_id), "coalesced")
+            else:
+                compacted += queue[start:packet_end]
+
+        queue.release()
+        self._packet_queue = compacted
+
+        # Packets that can't be dropped may keep it over the limit, so the next
+        # compaction waits until it doubles instead of running for every packet.
+        self._queue_limit = max(SETTING_USER_QUEUE_LIMIT, 2 * len(compacted))
+
     def enqueue(self, data: bytes) -> None:
+        # Broadcasts sent before this have to stay in front of it.
+        self._splice_broadcasts()
+
+        if packet_stats.enabled:
+            packet_stats.record_queued(data)
+
         self._packet_queue += data
+        if len(self._packet_queue) > self._queue_limit:
+            self._compact_queue()
 
     def dequeue(self) -> bytearray:
-        data = self._packet_queue.copy()
-        self._packet_queue.clear()
+        self._splice_broadcasts()
+
+        # The queue is handed over as is and replaced, not copied.
+        data = self._packet_queue
+        self._packet_queue = bytearray()
+        self._queue_limit = SETTING_USER_QUEUE_LIMIT
         return data
 
     def add_friend(self, friend_id: int) -> None:
@@ -2389,6 +4938,7 @@ class User:
 
         users.pop(token)
         user_id_to_token.pop(self.user_id)
+        online_presences.remove(self)
 
         if not self.restricted:
             broadcast_to_online_users(bancho_logout_packet(self.user_id))
@@ -2521,32 +5071,238 @@ class BanchoChannel:
                 if self.can_read(user.privileges):
                     user.enqueue(channel_packet)
 
-    def enqueue(self, data: bytes, exclude: list[int] = []) -> None:
-        for user in self.users:
-            if user.user_id not in exclude:
-                user.enqueue(data)
+    def enqueue(self, data: bytes, exclude: list[int] = []) -> None:
+        for user in self.users:
+            if user.user_id not in exclude:
+                user.enqueue(data)
+
+    def send(self, message: str, sender: User) -> None:
+        for user in filter(lambda x: x != sender, self.users):
+            user.send(message, sender, self)
+
+
+users: dict[str, User] = {}
+user_id_to_token: dict[int, str] = {}
+username_to_token: dict[str, str] = {}
+channels: dict[str, BanchoChannel] = {}
+
+
+metrics.gauge(
+    "onecho_online_users",
+    "Users currently logged in, including the bot.",
+).set_function(lambda: {(): len(users)})
+metrics.gauge(
+    "onecho_user_queue_bytes",
+    "Bytes waiting in a user's packet queue for their next poll.",
+    ("user_id",),
+).set_function(
+    lambda: {
+        (str(user.user_id),): user.queued_bytes
+        for user in users.values()
+        if not user.is_bot_client
+    }
+)
+metrics.gauge(
+    "onecho_queued_bytes",
+    "Bytes waiting in all packet queues, pending broadcasts counted per user.",
+).set_function(
+    lambda: {
+        (): sum(user.queued_bytes for user in users.values() if not user.is_bot_client)
+    }
+)
+metrics.gauge(
+    "onecho_channel_users",
+    "Users currently in a channel.",
+    ("channel",),
+).set_function(lambda: {(name,): len(channel) for name, channel in channels.items()})
+
+
+class OnlinePresenceBundle:
+    # The presence (and stats) packets of every visible online user, joined
+    # into one buffer so logins and presence requests just copy it.
+    def __init__(self) -> None:
+        self._users: dict[int, User] = {}
+        self._presences: bytes | None = None
+        self._presences_and_stats: bytes | None = None
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def update(self, user: User) -> None:
+        visible = not user.restricted and users.get(user.osu_token) is user
+        known = self._users.get(user.user_id) is user
+
+        if visible:
+            self._users[user.user_id] = user
+        elif known:
+            del self._users[user.user_id]
+        else:
+            return
+
+        self._presences_and_stats = None
+        if not known or not visible or user._presence_packet is None:
+            self._presences = None
+
+    def remove(self, user: User) -> None:
+        if self._users.get(user.user_id) is user:
+            del self._users[user.user_id]
+            self._presences = None
+            self._presences_and_stats = None
+
+    def presences(self) -> bytes:
+        if self._presences is None:
+            self._presences = b"".join(
+                user.presence_packet() for user in self._users.values()
+            )
+
+        return self._presences
+
+    def presences_and_stats(self) -> bytes:
+        if self._presences_and_stats is None:
+            self._presences_and_stats = b"".join(
+                user.presence_and_stats_packet() for user in self._users.values()
+            )
+
+        return self._presences_and_stats
+
+
+online_presences = OnlinePresenceBundle()
+
+
+class BroadcastLog:
+    # Packets for every online user are appended here once instead of being
+    # copied into each queue. Users keep a cursor into the log and splice in
+    # what they haven't seen yet when they poll or get a packet of their own.
+    __slots__ = ("max_size", "_entries", "_offsets", "_first_seq", "_size")
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+
+        self._entries: list[tuple[bytes, frozenset[int] | None]] = []
+        # Bytes in the log before each entry.
+        self._offsets: list[int] = []
+        self._first_seq = 0
+        self._size = 0
+
+    @property
+    def next_seq(self) -> int:
+        return self._first_seq + len(self._entries)
+
+    @property
+    def full(self) -> bool:
+        return self._size > self.max_size
+
+    def append(self, data: bytes, exclude: list[int]) -> None:
+        self._entries.append((bytes(data), frozenset(exclude) if exclude else None))
+        self._offsets.append(self._size)
+        self._size += len(data)
+
+    def read_into(self, buffer: bytearray, cursor: int, user_id: int) -> int:
+        # Appends everything after `cursor` meant for `user_id`, returns the new cursor.
+        for data, exclude in self._entries[max(cursor - self._first_seq, 0) :]:
+            if exclude is not None and user_id in exclude:
+                continue
+
+            if packet_stats.enabled:
+                packet_stats.record_queued(data)
+            buffer += data
+
+        return self.next_seq
+
+    def pending_bytes(self, cursor: int) -> int:
+        # Entries the user is excluded from are counted too.
+        index = cursor - self._first_seq
+        if index >= len(self._entries):
+            return 0
+
+        return self._size - self._offsets[max(index, 0)]
 
-    def send(self, message: str, sender: User) -> None:
-        for user in filter(lambda x: x != sender, self.users):
-            user.send(message, sender, self)
+    def clear(self) -> None:
+        self._first_seq = self.next_seq
+        self._entries.clear()
+        self._offsets.clear()
+        self._size = 0
 
 
-users: dict[str, User] = {}
-user_id_to_token: dict[int, str] = {}
-username_to_token: dict[str, str] = {}
-channels: dict[str, BanchoChannel] = {}
+broadcast_log = BroadcastLog(max_size=SETTING_BROADCAST_LOG_SIZE)
 
 
 def broadcast_to_online_users(data: bytes, exclude: list[int] = []) -> None:
+    broadcast_log.append(data, exclude)
+    if not broadcast_log.full:
+        return
+
+    # Users who haven't polled in a while get their part copied before it goes.
     for user in users.values():
-        if user.user_id not in exclude:
-            user.enqueue(data)
+        user._splice_broadcasts()
+    broadcast_log.clear()
 
 
 def add_user_to_cache(user: User) -> None:
     users[user.osu_token] = user
     user_id_to_token[user.user_id] = user.osu_token
     username_to_token[user.username_safe] = user.osu_token
+    online_presences.update(user)
+
+    # Only broadcasts sent from now on are theirs, the bot doesn't read any.
+    if not user.is_bot_client:
+        user._broadcast_cursor = broadcast_log.next_seq
+
+
+sessions_reaped_total = metrics.counter(
+    "onecho_sessions_reaped_total",
+    "Sessions logged out because their client stopped polling.",
+)
+
+
+class SessionReaper:
+    # Crashed clients never send a logout, so sessions that stopped polling are
+    # logged out here instead of receiving every broadcast forever.
+    def __init__(self, *, timeout: float, interval: float, batch_size: int) -> None:
+        self.timeout = timeout
+        self.interval = interval
+        self.batch_size = batch_size
+
+    def _is_idle(self, user: User, now: float) -> bool:
+        return not user.is_bot_client and now - user.last_poll_at > self.timeout
+
+    async def reap(self) -> int:
+        now = time.monotonic()
+        idle_users = [user for user in users.values() if self._is_idle(user, now)]
+
+        reaped = 0
+        for start in range(0, len(idle_users), self.batch_size):
+            for user in idle_users[start : start + self.batch_size]:
+                # They may have polled or logged out while we yielded.
+                online = users.get(user.osu_token) is user
+                if not online or not self._is_idle(user, now):
+                    continue
+
+                # One broken logout shouldn't stop the reaper for good.
+                try:
+                    user.logout()
+                except Exception:
+                    error(
+                        f"Failed to log out idle session of {user.username} ({user.user_id})",
+                        extra={"traceback": traceback.format_exc()},
+                    )
+                    continue
+
+                reaped += 1
+
+            # Every logout is a broadcast, let requests through between batches.
+            await asyncio.sleep(0)
+
+        if reaped:
+            sessions_reaped_total.inc(amount=reaped)
+            info(f"Logged out {reaped} sessions idle for over {self.timeout:g}s.")
+
+        return reaped
+
+    async def serve(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.reap()
 
 
 # Bancho Objects END
@@ -2706,7 +5462,46 @@ class PingCommand(BotCommand):
         return self
 
 
+class PacketStatsCommand(BotCommand):
+    def __init__(self) -> None:
+        super().__init__(
+            name="!packets",
+            description="Show the busiest packet types, or turn their stats on and off.",
+            priv_req=BanchoPrivileges.DEVELOPER,
+            allow_channels=False,
+        )
+
+    async def execute(
+        self, user: User, args: list[str], in_channel: bool = False
+    ) -> BotCommand | None:
+        if not self._process_sanity_checks(user, in_channel):
+            return None
+
+        if args and args[0].lower() in ("on", "off"):
+            packet_stats.enabled = args[0].lower() == "on"
+            self.response = f"Packet stats turned {args[0].lower()}."
+            return self
+
+        if not packet_stats.enabled:
+            self.response = "Packet stats are turned off."
+            return self
+
+        lines = []
+        for stat in packet_stats.snapshot()[:10]:
+            average_ms = (
+                stat.handler_seconds / stat.handled * 1000 if stat.handled else 0
+            )
+            lines.append(
+                f"{stat.packet}: {stat.received} in ({stat.received_bytes}B, "
+                f"{average_ms:.3f}ms avg), {stat.queued} out ({stat.queued_bytes}B)"
+            )
+
+        self.response = "\n".join(lines) or "No packets seen yet."
+        return self
+
+
 bancho_bot.add_command(PingCommand())
+bancho_bot.add_command(PacketStatsCommand())
 
 
 # Bancho Bot END
@@ -2744,12 +5539,16 @@ async def bancho_post(request: HTTPRequest) -> None:
     if user is None:
         await request.send_response(
             status_code=200,
-            body=bancho_notification_packet("Server has restarted!")
-            + bancho_server_restart_packet(0),
+            body=bancho_server_restart_packet(
+                0, out=bancho_notification_packet("Server has restarted!")
+            ),
         )
         return
 
+    user.last_poll_at = time.monotonic()
+
     packets = PacketContext.create_from_buffers(request.body)
+    request.log_context["packets"] = [packet_name(packet.id) for packet in packets]
     for packet in packets:
         await packets_router.route(packet, user)
 
@@ -2767,13 +5566,54 @@ class BanchoLoginResponse(TypedDict):
     packets: bytes
 
 
+background_tasks: set[asyncio.Task] = set()
+
+
+def spawn_background_task(coro: Awaitable[Any]) -> asyncio.Task:
+    # The event loop only keeps weak references to tasks.
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def resolve_user_geolocalisation(
+    user: User, ip: str | None, update_country: bool
+) -> None:
+    try:
+        async with asyncio.timeout(SETTING_GEOLOCATION_TIMEOUT):
+            geolocalisation = await get_user_geolocalisation(ip)
+    except TimeoutError:
+        warning(
+            f"Geolocation for {user.username} timed out, keeping the provisional one."
+        )
+        return
+
+    # They may have logged out while we were waiting.
+    if users.get(user.osu_token) is not user or geolocalisation == user.geoloc:
+        return
+
+    user.geoloc = geolocalisation
+    user.invalidate_packets()
+
+    if update_country:
+        user_model = user_db.from_id(user.user_id)
+        if user_model is not None:
+            user_model.result.country = geolocalisation.country_acronym
+            user_db.update(user.user_id, user_model.result)
+
+    if not user.restricted:
+        broadcast_to_online_users(user.presence_packet())
+
+
 async def bancho_login_handler(request: HTTPRequest) -> BanchoLoginResponse:
     username, password_hash, additional_data, _ = request.body.decode().split("\n")
     osu_ver, utc_offset, _, _, pm_private = additional_data.split("|")
 
-    geolocalisation = await get_user_geolocalisation(
-        request.headers.get("x-forwarded-for")
-    )
+    ip = request.headers.get("x-forwarded-for")
+    geolocalisation = peek_user_geolocalisation(ip)
+    if geolocalisation is None and not SETTING_GEOLOCATION_DEFERRED:
+        geolocalisation = await get_user_geolocalisation(ip)
 
     packet_response = bytearray()
 
@@ -2784,7 +5624,9 @@ async def bancho_login_handler(request: HTTPRequest) -> BanchoLoginResponse:
             username=username,
             email=f"changeme_{create_random_string(10)}@lol.xd",
             password_md5=password_hash,
-            country_acronym=geolocalisation.country_acronym,
+            country_acronym=(
+                geolocalisation.country_acronym if geolocalisation else "xx"
+            ),
         )
 
         user_id = user_resp["user_id"]
@@ -2804,6 +5646,16 @@ async def bancho_login_handler(request: HTTPRequest) -> BanchoLoginResponse:
             ),
         }
 
+    # Log in with the stored country for now, the real location follows later.
+    deferred_geolocalisation = geolocalisation is None
+    if geolocalisation is None:
+        geolocalisation = UserGeolocalisation(
+            country_acronym=user_model.country,
+            country_code=COUNTRY_CODES.get(user_model.country, COUNTRY_CODES["xx"]),
+            latitude=0.0,
+            longitude=0.0,
+        )
+
     user = User(
         user_id=user_id,
         username=user_model.username,
@@ -2831,8 +5683,8 @@ async def bancho_login_handler(request: HTTPRequest) -> BanchoLoginResponse:
 
     await user.update_ranks()
 
-    packet_response += bancho_login_reply_packet(user.user_id)
-    packet_response += bancho_protocol_packet()
+    bancho_login_reply_packet(user.user_id, out=packet_response)
+    bancho_protocol_packet(out=packet_response)
 
     for channel in channels.values():
         if (
@@ -2849,27 +5701,27 @@ async def bancho_login_handler(request: HTTPRequest) -> BanchoLoginResponse:
             if channel.can_read(u.privileges):
                 u.enqueue(chan_packet)
 
-    packet_response += bancho_channel_info_end_packet()
-    packet_response += bancho_silence_end_packet(user.silence_end)
-    packet_response += bancho_login_perms_packet(user.privileges)
-
-    for online_user in users.values():
-        if online_user.restricted:
-            continue
-
-        packet_response += online_user.presence_and_stats_packet()
+    bancho_channel_info_end_packet(out=packet_response)
+    bancho_silence_end_packet(user.silence_end, out=packet_response)
+    bancho_login_perms_packet(user.privileges, out=packet_response)
 
-    packet_response += user.presence_and_stats_packet()
-    packet_response += bancho_user_friends_packet(user.friends)
+    packet_response += online_presences.presences_and_stats()
+    user.presence_and_stats_packet(out=packet_response)
+    bancho_user_friends_packet(user.friends, out=packet_response)
 
     quote = random.choice(QUOTES)
-    packet_response += bancho_notification_packet(f"onecho! - {quote}")
+    bancho_notification_packet(f"onecho! - {quote}", out=packet_response)
 
     if not user.restricted:
         broadcast_to_online_users(user.presence_and_stats_packet())
 
     add_user_to_cache(user)
 
+    if deferred_geolocalisation:
+        spawn_background_task(
+            resolve_user_geolocalisation(user, ip, update_country=just_registered)
+        )
+
     user.update_user()
     return {
         "osu_token": user.osu_token,
@@ -2969,46 +5821,611 @@ def get_random_avatar(user_id: int | str) -> str:
     return hashed_filenames[closest_hash]
 
 
-def get_avatar_data(user_id: int) -> bytes:
+def get_avatar_path(user_id: int) -> str:
     if os.path.exists(f"avatars/{user_id}.png"):
-        path = f"avatars/{user_id}.png"
+        return f"avatars/{user_id}.png"
     elif os.path.exists(f"avatars/{user_id}.jpg"):
-        path = f"avatars/{user_id}.jpg"
-    else:
-        path = get_random_avatar(user_id)
+        return f"avatars/{user_id}.jpg"
 
-    with open(path, "rb") as f:
-        return f.read()
+    return get_random_avatar(user_id)
 
 
 @avatar_router.add_endpoint("/{}", methods=["GET"])
 async def avatar_handler(request: HTTPRequest) -> None:
     user_id = request.path.split("/")[-1]
     if not user_id.isdigit():
-        path = get_random_avatar(user_id)
-        with open(path, "rb") as f:
-            avatar_data = f.read()
-        await request.send_response(
-            status_code=200,
-            body=avatar_data,
-            headers={
-                "Content-Type": "image/png",
-            },
-        )
+        await response_static_file(request, get_random_avatar(user_id))
         return
 
-    avatar_data = get_avatar_data(int(user_id))
+    await response_static_file(request, get_avatar_path(int(user_id)))
 
+
+# Avatar Domain END
+
+
+# Metrics Domain START
+
+
+metrics_router = Router(SETTING_METRICS_DOMAIN)
+
+
+@metrics_router.add_endpoint(SETTING_METRICS_PATH, methods=["GET"])
+async def metrics_handler(request: HTTPRequest) -> None:
     await request.send_response(
         status_code=200,
-        body=avatar_data,
+        body=metrics.expose().encode("utf-8"),
         headers={
-            "Content-Type": "image/png",
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
         },
     )
 
 
-# Avatar Domain END
+# Metrics Domain END
+
+
+# Session Handoff START
+
+
+HANDOFF_ACK = b"\x01"
+
+
+def _user_to_snapshot(user: User) -> dict[str, Any]:
+    # Pending broadcasts are moved into the queue, the log isn't handed off.
+    user._splice_broadcasts()
+
+    return {
+        "user_id": user.user_id,
+        "username": user.username,
+        "username_safe": user.username_safe,
+        "email": user.email,
+        "osu_token": user.osu_token,
+        "osu_version": user.osu_version,
+        "utc_offset": user.utc_offset,
+        "pm_private": user.pm_private,
+        "privileges": user.privileges.value,
+        "geoloc": {
+            "country_acronym": user.geoloc.country_acronym,
+            "country_code": user.geoloc.country_code,
+            "latitude": user.geoloc.latitude,
+            "longitude": user.geoloc.longitude,
+        },
+        "silence_end": user.silence_end,
+        "login_time": user.login_time,
+        "latest_activity": user.latest_activity,
+        "status": {
+            "action": user.status.action.value,
+            "action_text": user.status.action_text,
+            "action_md5": user.status.action_md5,
+            "mods": user.status.mods.value,
+            "mode": user.status.mode.value,
+            "beatmap_id": user.status.beatmap_id,
+        },
+        "friends": user.friends,
+        "blocks": user.blocks,
+        "in_lobby": user.in_lobby,
+        "channels": [
+            channel.name for channel in user.channels if not channel.temporary
+        ],
+        "packet_queue": base64.b64encode(user._packet_queue).decode(),
+    }
+
+
+def snapshot_sessions() -> dict[str, Any]:
+    online_users = [user for user in users.values() if not user.is_bot_client]
+
+    return {
+        "users": [_user_to_snapshot(user) for user in online_users],
+        "watch_parties": [
+            {
+                "the_watched": user.user_id,
+                "the_watchers": [
+                    watcher.user_id for watcher in user.watch_party.the_watchers
+                ],
+            }
+            for user in online_users
+            if user.watch_party is not None
+        ],
+    }
+
+
+async def restore_sessions(snapshot: dict[str, Any]) -> None:
+    for data in snapshot["users"]:
+        user = User(
+            user_id=data["user_id"],
+            username=data["username"],
+            username_safe=data["username_safe"],
+            email=data["email"],
+            osu_token=data["osu_token"],
+            osu_version=data["osu_version"],
+            utc_offset=data["utc_offset"],
+            pm_private=data["pm_private"],
+            privileges=BanchoPrivileges(data["privileges"]),
+            geoloc=UserGeolocalisation(**data["geoloc"]),
+            silence_end=data["silence_end"],
+            login_time=data["login_time"],
+            latest_activity=data["latest_activity"],
+            status=BanchoUserStatus(
+                action=BanchoAction(data["status"]["action"]),
+                action_text=data["status"]["action_text"],
+                action_md5=data["status"]["action_md5"],
+                mods=OsuMods(data["status"]["mods"]),
+                mode=OsuMode(data["status"]["mode"]),
+                beatmap_id=data["status"]["beatmap_id"],
+            ),
+            friends=data["friends"],
+            blocks=data["blocks"],
+            in_lobby=data["in_lobby"],
+        )
+        user.fetch_stats_from_database()
+        await user.update_ranks()
+        user.enqueue(base64.b64decode(data["packet_queue"]))
+
+        # Membership is restored silently, the clients already know about it.
+        for channel_name in data["channels"]:
+            channel = channels.get(channel_name)
+            if channel is not None:
+                channel.append(user)
+                user.channels.append(channel)
+
+        add_user_to_cache(user)
+
+    for data in snapshot["watch_parties"]:
+        the_watched = users.get(user_id_to_token.get(data["the_watched"], ""))
+        if the_watched is None:
+            continue
+
+        the_watchers = [
+            users[user_id_to_token[user_id]]
+            for user_id in data["the_watchers"]
+            if user_id in user_id_to_token
+        ]
+        if not the_watchers:
+            continue
+
+        the_watched.watch_party = UserWatchParty(
+            the_watched=the_watched,
+            the_watchers=the_watchers,
+            channel=BanchoChannel(
+                _name=f"#spec_{the_watched.user_id}",
+                topic=f"Watch party for {the_watched.username!r}",
+                write_privileges=BanchoPrivileges.PLAYER,
+                read_privileges=BanchoPrivileges.PLAYER,
+                auto_join=False,
+                temporary=True,
+            ),
+        )
+
+        for user in [the_watched, *the_watchers]:
+            the_watched.watch_party.channel.append(user)
+            user.channels.append(the_watched.watch_party.channel)
+
+    info(f"Restored {len(snapshot['users'])} sessions from the previous process.")
+
+
+class SessionHandoff:
+    """Hands the listening sockets and all sessions over to a process started
+    with the `takeover` argument, so deployments don't log everyone out."""
+
+    def __init__(self, server: AsyncHTTPServer, path: str) -> None:
+        self._server = server
+        self._path = path
+
+    def _listen(self) -> socket.socket:
+        try:
+            if stat.S_ISSOCK(os.stat(self._path).st_mode):
+                os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self._path)
+        os.chmod(self._path, 0o600)
+        sock.setblocking(False)
+        sock.listen(1)
+        return sock
+
+    def _close(self, sock: socket.socket) -> None:
+        sock.close()
+
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+    async def serve(self) -> None:
+        loop = asyncio.get_event_loop()
+
+        while True:
+            control = self._listen()
+            try:
+                connection, _ = await loop.sock_accept(control)
+            finally:
+                # Frees the path for the new process to bind once it took over.
+                self._close(control)
+
+            with connection:
+                if await self._hand_off(connection):
+                    return
+
+    async def _hand_off(self, connection: socket.socket) -> bool:
+        loop = asyncio.get_event_loop()
+        info("A new process requested a takeover, handing off.")
+
+        self._server.pause_accepting()
+        await self._server.drain(SETTING_HANDOFF_DRAIN_TIMEOUT)
+
+        sockets = self._server.listening_sockets
+        payload = json.dumps(
+            {
+                "listeners": [
+                    [listener.address, listener.port] for listener, _ in sockets
+                ],
+                "sessions": snapshot_sessions(),
+            }
+        ).encode("utf-8")
+
+        try:
+            # There's no event loop version of `send_fds`.
+            await loop.run_in_executor(
+                None,
+                functools.partial(
+                    socket.send_fds,
+                    connection,
+                    [struct.pack("<Q", len(payload))],
+                    [sock.fileno() for _, sock in sockets],
+                ),
+            )
+
+            connection.setblocking(False)
+            await loop.sock_sendall(connection, payload)
+
+            async with asyncio.timeout(SETTING_HANDOFF_TIMEOUT):
+                ack = await loop.sock_recv(connection, 1)
+
+            if ack != HANDOFF_ACK:
+                raise ConnectionError("The new process did not acknowledge.")
+        except OSError:
+            error(f"Handoff failed, resuming service.\n{traceback.format_exc()}")
+            self._server.resume_accepting()
+            return False
+
+        info("Handoff complete, shutting down.")
+        self._server.stop(handed_off=True)
+        return True
+
+
+@dataclass
+class HandoffState:
+    sockets: dict[HTTPListener, socket.socket]
+    sessions: dict[str, Any]
+    connection: socket.socket
+
+    async def acknowledge(self) -> None:
+        loop = asyncio.get_event_loop()
+
+        with self.connection:
+            self.connection.setblocking(False)
+            await loop.sock_sendall(self.connection, HANDOFF_ACK)
+
+
+async def receive_handoff(path: str) -> HandoffState | None:
+    # `recv_fds` has no event loop version, so the whole exchange runs in a thread.
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _receive_handoff, path)
+
+
+def _receive_handoff(path: str) -> HandoffState | None:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(SETTING_HANDOFF_TIMEOUT)
+
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        warning("There is no running server to take over from, starting fresh.")
+        return None
+
+    header, fds, _, _ = socket.recv_fds(connection, 8, 64)
+    (length,) = struct.unpack("<Q", header)
+
+    payload = bytearray()
+    while len(payload) < length:
+        chunk = connection.recv(min(65536, length - len(payload)))
+        if not chunk:
+            raise ConnectionError("The old process went away mid-handoff.")
+        payload += chunk
+
+    data = json.loads(payload)
+    return HandoffState(
+        sockets={
+            HTTPListener(address, port): socket.socket(fileno=fd)
+            for (address, port), fd in zip(data["listeners"], fds)
+        },
+        sessions=data["sessions"],
+        connection=connection,
+    )
+
+
+# Session Handoff END
+
+
+# Packet Codec Tools START
+
+
+# Run with `bench` or `fuzz` instead of starting the server.
+CODEC_SAMPLE_FRAMES = bytes(range(256)) * 2
+
+# Outbound builders, each appends one packet to the given buffer.
+CODEC_ENCODE_CASES: dict[str, Callable[[bytearray], Any]] = {
+    "login_reply": lambda out: bancho_login_reply_packet(1000, out),
+    "notification": lambda out: bancho_notification_packet("Welcome to onecho!", out),
+    "send_message": lambda out: out.extend(
+        bancho_send_message_packet("tester", "hello there!", "#osu", 1000)
+    ),
+    "user_presence": lambda out: bancho_user_presence_packet(bancho_bot, out),
+    "user_stats": lambda out: bancho_user_stats_packet(bancho_bot, out),
+    "friends_list": lambda out: bancho_user_friends_packet(list(range(64)), out),
+    "spectate_frames": lambda out: out.extend(
+        bancho_spectate_frames(CODEC_SAMPLE_FRAMES)
+    ),
+}
+
+# Inbound packets as the client sends them, decoded the way the router does.
+CODEC_DECODE_CASES: dict[str, tuple[PacketSchema | None, bytes]] = {
+    "heartbeat": (None, bytes(PacketWriter(BanchoPacketID.OSU_HEARTBEAT).finish())),
+    "change_action": (
+        CHANGE_ACTION_SCHEMA,
+        bytes(
+            PacketWriter(BanchoPacketID.OSU_CHANGE_ACTION)
+            .write_u8(BanchoAction.PLAYING)
+            .write_str("Camellia - Exit This Earth's Atomosphere [Evolution]")
+            .write_str("d41d8cd98f00b204e9800998ecf8427e")
+            .write_i32(OsuMods.HIDDEN | OsuMods.HARDROCK)
+            .write_u8(OsuMode.OSU)
+            .write_i32(2137)
+            .finish()
+        ),
+    ),
+    "send_public_message": (
+        MESSAGE_SCHEMA,
+        bytes(
+            PacketWriter(BanchoPacketID.OSU_SEND_PUBLIC_MESSAGE)
+            .write_str("")
+            .write_str("hello there!")
+            .write_str("#osu")
+            .write_i32(0)
+            .finish()
+        ),
+    ),
+    "user_stats_request": (
+        USER_ID_LIST_SCHEMA,
+        bytes(
+            PacketWriter(BanchoPacketID.OSU_USER_STATS_REQUEST)
+            .write_list(list(range(1000, 1032)))
+            .finish()
+        ),
+    ),
+    "spectate_frames": (
+        SPECTATE_FRAMES_SCHEMA,
+        bytes(
+            PacketWriter(BanchoPacketID.OSU_SPECTATE_FRAMES)
+            .write_raw(CODEC_SAMPLE_FRAMES)
+            .finish()
+        ),
+    ),
+}
+
+CODEC_SCHEMAS = (
+    CHANGE_ACTION_SCHEMA,
+    USER_ID_LIST_SCHEMA,
+    USER_ID_SCHEMA,
+    CHANNEL_SCHEMA,
+    VALUE_SCHEMA,
+    MESSAGE_SCHEMA,
+    SPECTATE_FRAMES_SCHEMA,
+)
+
+
+def _best_call_time(func: Callable[[], Any]) -> float:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number
+
+
+def _report_throughput(
+    mode: str, name: str, batch_size: int, packet_size: int, seconds: float
+) -> None:
+    packets_per_second = batch_size / seconds
+    bytes_per_second = packets_per_second * packet_size
+    info(
+        f"{mode} {name} x{batch_size}: {packets_per_second:,.0f} packets/s, "
+        f"{bytes_per_second / 1024 / 1024:,.1f} MiB/s",
+        extra={
+            "mode": mode,
+            "packet": name,
+            "batch_size": batch_size,
+            "packet_size": packet_size,
+            "packets_per_second": packets_per_second,
+            "bytes_per_second": bytes_per_second,
+        },
+    )
+
+
+def run_packet_benchmark(batch_sizes: list[int]) -> int:
+    for name, build in CODEC_ENCODE_CASES.items():
+        sample = bytearray()
+        build(sample)
+        packet_size = len(sample)
+
+        for batch_size in batch_sizes:
+
+            def encode_batch() -> None:
+                out = bytearray()
+                for _ in range(batch_size):
+                    build(out)
+
+            seconds = _best_call_time(encode_batch)
+            _report_throughput("encode", name, batch_size, packet_size, seconds)
+
+    for name, (schema, packet) in CODEC_DECODE_CASES.items():
+        for batch_size in batch_sizes:
+            body = packet * batch_size
+
+            def decode_batch() -> None:
+                for ctx in PacketContext.create_from_buffers(body):
+                    if schema is not None:
+                        ctx.reader.read_record(schema)
+
+            seconds = _best_call_time(decode_batch)
+            _report_throughput("decode", name, batch_size, len(packet), seconds)
+
+    return 0
+
+
+def _random_packet_str(rng: random.Random) -> str:
+    # Long enough now and then for the length to take several uleb128 bytes.
+    length = rng.choice((0, 1, rng.randrange(128), rng.randrange(128, 512)))
+    alphabet = string.printable + "ąćęłńóśźż日本語🎵"
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def _random_field(rng: random.Random, wire_type: str, hint: Any) -> Any:
+    if isinstance(hint, type) and issubclass(hint, Enum):
+        return rng.choice(list(hint))
+    if wire_type == "str":
+        return _random_packet_str(rng)
+    if wire_type == "list":
+        return [rng.randrange(-(2**31), 2**31) for _ in range(rng.randrange(64))]
+    if wire_type == "raw":
+        return rng.randbytes(rng.randrange(1024))
+    if wire_type == "f32":
+        return F32.unpack(F32.pack(rng.uniform(-1e6, 1e6)))[0]
+
+    bits = struct.calcsize(PACKET_FIELD_FORMATS[wire_type]) * 8
+    # `write_i8` appends the byte as is, so it only takes the positive half.
+    if wire_type.startswith("u") or wire_type == "i8":
+        return rng.randrange(2 ** (bits - 1 if wire_type == "i8" else bits))
+    return rng.randrange(-(2 ** (bits - 1)), 2 ** (bits - 1))
+
+
+def _random_packet(rng: random.Random) -> tuple[PacketSchema, tuple, bytes]:
+    schema = rng.choice(CODEC_SCHEMAS)
+    packet_id = rng.choice(list(BanchoPacketID))
+    hints = get_type_hints(schema.record)
+
+    record = schema.record(
+        *(
+            _random_field(rng, wire_type, hints[name])
+            for wire_type, name in zip(schema.wire_types, schema.record._fields)  # type: ignore
+        )
+    )
+
+    packet = PacketWriter(packet_id)
+    for wire_type, value in zip(schema.wire_types, record):
+        getattr(packet, f"write_{wire_type}")(value)
+
+    return schema, record, bytes(packet.finish())
+
+
+class FuzzFailure(AssertionError):
+    pass
+
+
+def _expect(condition: bool, message: str) -> None:
+    # Not an `assert`, those are gone under `python -O`.
+    if not condition:
+        raise FuzzFailure(message)
+
+
+def _check_framing(buf: bytes) -> list[PacketContext]:
+    ctxs = PacketContext.create_from_buffers(buf)
+
+    pos = 0
+    for ctx in ctxs:
+        packet_id, length = PACKET_HEADER.unpack_from(buf, pos)
+        pos += PACKET_HEADER.size
+
+        _expect(ctx.id == packet_id, f"Framed ID {ctx.id} instead of {packet_id}.")
+        _expect(
+            ctx.length == length, f"Framed length {ctx.length} instead of {length}."
+        )
+        _expect(
+            ctx.reader.read_remaining_bytes() == buf[pos : pos + length],
+            "Payload doesn't match the input.",
+        )
+        pos += length
+
+    _expect(len(buf) - pos < PACKET_HEADER.size, "Trailing packet was not framed.")
+    return ctxs
+
+
+def _check_decoding(ctx: PacketContext) -> None:
+    view = memoryview(ctx.reader.read_remaining_bytes())
+    for schema in CODEC_SCHEMAS:
+        try:
+            _, pos = schema.decode_from(view)
+        except PacketDecodeError:
+            continue
+
+        _expect(pos <= len(view), f"{schema.record.__name__} read past the payload.")
+
+
+def _fuzz_case(rng: random.Random) -> None:
+    strategy = rng.randrange(4)
+
+    if strategy == 0:
+        # Random garbage, including headers with absurd lengths.
+        buf = rng.randbytes(rng.randrange(64))
+        for ctx in _check_framing(buf):
+            _check_decoding(ctx)
+        return
+
+    packets = [_random_packet(rng) for _ in range(rng.randrange(1, 6))]
+    buf = b"".join(packet for _, _, packet in packets)
+
+    if strategy == 1:
+        # Valid packets have to survive the round trip untouched.
+        ctxs = _check_framing(buf)
+        _expect(len(ctxs) == len(packets), f"Framed {len(ctxs)} of {len(packets)}.")
+
+        for ctx, (schema, record, _) in zip(ctxs, packets):
+            decoded = ctx.reader.read_record(schema)
+            _expect(decoded == record, f"Decoded {decoded!r} instead of {record!r}.")
+            _expect(ctx.reader.empty, f"{schema.record.__name__} left unread bytes.")
+    elif strategy == 2:
+        # A body cut short anywhere, as when a client disconnects mid-request.
+        for ctx in _check_framing(buf[: rng.randrange(len(buf))]):
+            _check_decoding(ctx)
+    else:
+        corrupted = bytearray(buf)
+        for _ in range(rng.randrange(1, 8)):
+            corrupted[rng.randrange(len(corrupted))] = rng.randrange(256)
+
+        for ctx in _check_framing(bytes(corrupted)):
+            _check_decoding(ctx)
+
+
+def run_packet_fuzz(iterations: int, seed: int) -> int:
+    info(f"Fuzzing the packet codec for {iterations} iterations with seed {seed}.")
+
+    failures = 0
+    for iteration in range(iterations):
+        # Every case gets its own seed so a failure can be replayed on its own.
+        case_seed = seed + iteration
+        try:
+            _fuzz_case(random.Random(case_seed))
+        except Exception as exc:
+            failures += 1
+            error(
+                f"Codec fuzz case {case_seed} failed: {exc!r}",
+                extra={"seed": case_seed, "traceback": traceback.format_exc()},
+            )
+
+    info(f"Codec fuzzing finished with {failures} failures.")
+    return 1 if failures else 0
+
+
+# Packet Codec Tools END
 
 
 # Server Entry Point START
@@ -3065,15 +6482,86 @@ async def main() -> int:
         channels[f"#{channel.result.name}"] = BanchoChannel.from_model(channel.result)
 
     # Initialise server
-    server = AsyncHTTPServer(address=SETTING_HTTP_HOST, port=SETTING_HTTP_PORT)
+    server = AsyncHTTPServer(
+        address=SETTING_HTTP_HOST,
+        port=SETTING_HTTP_PORT,
+        listen_tcp=SETTING_HTTP_TCP_ENABLED,
+    )
+    for path in SETTING_HTTP_UNIX_SOCKETS:
+        server.add_listener(HTTPListener(path))
+
     server.add_router(bancho_router)
     server.add_router(avatar_router)
+    server.add_router(metrics_router)
+
+    timing_middleware = RequestTimingMiddleware(
+        slow_threshold=SETTING_SLOW_REQUEST_THRESHOLD,
+    )
+    timing_middleware.install(server)
+
+    metrics.gauge(
+        "onecho_http_connections",
+        "Connections currently being handled by the HTTP server.",
+    ).set_function(lambda: {(): server.active_connections})
+
+    if TAKEOVER and SETTING_HANDOFF_SOCKET:
+        handoff_state = await receive_handoff(SETTING_HANDOFF_SOCKET)
+
+        if handoff_state is not None:
+            # Acknowledged before the slow restore, the old process only waits
+            # `HANDOFF_TIMEOUT` before it resumes serving on these sockets.
+            try:
+                await handoff_state.acknowledge()
+            except OSError:
+                error("The old process gave up on the handoff, not taking over.")
+                for sock in handoff_state.sockets.values():
+                    sock.close()
+                return 1
+
+            await restore_sessions(handoff_state.sessions)
+            for listener, sock in handoff_state.sockets.items():
+                server.adopt_socket(listener, sock)
+
+    handoff_task = None
+    if SETTING_HANDOFF_SOCKET:
+        handoff = SessionHandoff(server, SETTING_HANDOFF_SOCKET)
+        handoff_task = asyncio.get_event_loop().create_task(handoff.serve())
+
+    reaper_task = None
+    if SETTING_SESSION_IDLE_TIMEOUT > 0:
+        reaper = SessionReaper(
+            timeout=SETTING_SESSION_IDLE_TIMEOUT,
+            interval=SETTING_SESSION_REAP_INTERVAL,
+            batch_size=SETTING_SESSION_REAP_BATCH_SIZE,
+        )
+        reaper_task = asyncio.get_event_loop().create_task(reaper.serve())
+
+    if SETTING_GEOLOCATION_DATABASE:
+        ip_range_database.load(SETTING_GEOLOCATION_DATABASE)
+    geolocation_cache.load()
 
     await server.start_server()
+
+    # After a handoff the cache file belongs to the new process.
+    if not server.handed_off:
+        geolocation_cache.save()
+
+    if handoff_task is not None:
+        handoff_task.cancel()
+
+    if reaper_task is not None:
+        reaper_task.cancel()
+
+    await http_client.close()
     return 0
 
 
 if __name__ == "__main__":
+    if BENCHMARK:
+        raise SystemExit(run_packet_benchmark(SETTING_BENCHMARK_BATCH_SIZES))
+    if FUZZ:
+        raise SystemExit(run_packet_fuzz(SETTING_FUZZ_ITERATIONS, SETTING_FUZZ_SEED))
+
     raise SystemExit(asyncio.run(main()))
 
 